@@ -0,0 +1,456 @@
+"""Offline benchmark for the bot's message handlers.
+
+Generates synthetic REES/VOLS/zones data, replaces the Telegram Bot API with a
+local stub and replays update streams through handle_message and /webhook.
+
+    python bench.py --regions 4 --rows 20000 --vols-rows 20000 --iterations 300
+    python bench.py --replay updates.jsonl
+    python bench.py --state memory
+    python bench.py --check-reload
+"""
+import os
+import sys
+import json
+import time
+import random
+import atexit
+import shutil
+import argparse
+import tempfile
+import itertools
+
+# === ARGUMENTS (parsed before main is imported, it reads its config from the environment) ===
+parser = argparse.ArgumentParser(description="Offline benchmark for the bot's message handlers")
+parser.add_argument("--regions",     type=int,   default=4,     help="number of REES regions")
+parser.add_argument("--rows",        type=int,   default=20000, help="rows per REES region")
+parser.add_argument("--vols-rows",   type=int,   default=20000, help="rows in the VOLS sheet")
+parser.add_argument("--users",       type=int,   default=200,   help="users in the zones map")
+parser.add_argument("--iterations",  type=int,   default=300,   help="timed updates per flow")
+parser.add_argument("--flows",       default="",                help="comma separated subset of flows")
+parser.add_argument("--replay",      default=None,              help="jsonl file of recorded Telegram updates")
+parser.add_argument("--workers",     type=int,   default=4,     help="UPDATE_WORKERS for the webhook run")
+parser.add_argument("--api-latency", type=float, default=0.0,   help="simulated Bot API latency, ms")
+parser.add_argument("--no-webhook",  action="store_true",       help="skip the /webhook run")
+parser.add_argument("--metrics",     action="store_true",       help="keep METRICS_ENABLED on")
+parser.add_argument("--state",       default="sqlite", choices=("sqlite", "memory", "redis"),
+                    help="STATE_BACKEND; sqlite uses a throwaway db file")
+parser.add_argument("--redis-url",   default=None,              help="REDIS_URL for --state redis")
+parser.add_argument("--seed",        type=int,   default=1)
+parser.add_argument("--json",        default=None,              help="also write the report to this file")
+parser.add_argument("--check-reload", action="store_true",      help="check delta reloads against full rebuilds and exit")
+args = parser.parse_args()
+
+state_env = {"STATE_BACKEND": args.state}
+if args.state == "sqlite":
+    state_dir = tempfile.mkdtemp(prefix="bench-state-")
+    atexit.register(shutil.rmtree, state_dir, ignore_errors=True)
+    state_env["STATE_DB_PATH"] = os.path.join(state_dir, "state.db")
+if args.redis_url:
+    state_env["REDIS_URL"] = args.redis_url
+
+os.environ.update({
+    "TOKEN":           "123456:BENCHMARK",
+    "AUTO_WARMUP":     "0",
+    "SNAPSHOT_DIR":    "",
+    **state_env,
+    "UPDATE_WORKERS":  str(args.workers),
+    "UPDATE_QUEUE_MAX": "100000",
+    "METRICS_ENABLED": "1" if args.metrics else "0",
+    "REES_SHEETS_MAP": ",".join(f"РЭС-{i}=bench://rees/{i}" for i in range(1, args.regions + 1)),
+    "VOLS_SHEETS_URL": "bench://vols",
+})
+
+import numpy as np
+import pandas as pd
+import main
+from telegram.ext import TypeHandler
+
+rnd = random.Random(args.seed)
+
+# === SYNTHETIC DATA ===
+STREETS   = ["Ленина", "Мира", "Советская", "Садовая", "Полевая", "Школьная", "Заречная"]
+TOWNS     = ["Ставрополь", "Михайловск", "Изобильный", "Светлоград", "Ипатово"]
+PROVIDERS = ["ООО Связь", "ПАО Ростелеком", "ИП Иванов", "ООО Телеком-Юг", "АО Оптика", "ООО (Нет)Лимит"]
+REGIONS   = list(main.REES_SHEETS_MAP)
+
+def meter_number() -> str:
+    # some exports keep leading zeros, some do not
+    n = str(rnd.randint(1, 10**9))
+    return n.zfill(rnd.choice((0, 11, 12))) if rnd.random() < 0.3 else n
+
+def make_region(rows: int) -> pd.DataFrame:
+    cols = {c for group in main.INFO_COLS.values() for c in group}
+    data = {c: [f"{c[:12]} {rnd.randint(1, 999)}" for _ in range(rows)] for c in cols}
+    data[main.METER_COL]     = [meter_number() for _ in range(rows)]
+    data["Населенный пункт"] = [rnd.choice(TOWNS) for _ in range(rows)]
+    data["Улица"]            = [rnd.choice(STREETS) for _ in range(rows)]
+    data["ТП"]               = [f"ТП-{rnd.randint(1, 3000)}" for _ in range(rows)]
+    return pd.DataFrame(data, dtype=str)
+
+def make_vols(rows: int) -> pd.DataFrame:
+    return pd.DataFrame({
+        main.VOLS_RES_COL:  [rnd.choice(REGIONS) for _ in range(rows)],
+        "Наименование ТП":  [f"ТП-{rnd.randint(1, max(rows // 20, 1))}" for _ in range(rows)],
+        main.VOLS_PROV_COL: [f"{rnd.choice(PROVIDERS)}-{rnd.randint(1, 50)}" for _ in range(rows)],
+        "ФИДЕР":            [f"Ф-{rnd.randint(1, 40)}" for _ in range(rows)],
+        "ВУ":               [f"ВУ-{rnd.randint(1, 9)}" for _ in range(rows)],
+        "Опоры":            [f"{rnd.randint(1, 50)}-{rnd.randint(51, 99)}" for _ in range(rows)],
+    }, dtype=str)
+
+def make_zones_csv(users: int) -> str:
+    lines = ["ID,Region,Имя,Region_ТП"]
+    for uid in range(1, users + 1):
+        region = rnd.choice(REGIONS + ["ALL", "admin"])
+        res    = "ALL" if region in ("ALL", "admin") else region
+        lines.append(f"{100000 + uid},{region},Пользователь {uid},{res}")
+    return "\n".join(lines)
+
+# === BOT API STUB ===
+class FakeRequest:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.ids     = itertools.count(1)
+        self.last    = {}   # chat_id -> last message payload
+        self.inline  = {}   # chat_id -> last message payload with inline buttons
+
+    def post(self, url, data=None, timeout=None):
+        if self.latency:
+            time.sleep(self.latency)
+        method = url.rsplit("/", 1)[1]
+        data   = data or {}
+        if method == "getMe":
+            return {"id": 123456, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        if method == "answerCallbackQuery":
+            return True
+        chat_id = int(data.get("chat_id", 0))
+        msg = {"message_id": data.get("message_id") or next(self.ids), "date": int(time.time()),
+               "chat": {"id": chat_id, "type": "private"}, "text": data.get("text", "")}
+        if method == "sendPhoto":
+            msg["photo"] = [{"file_id": f"bench-{msg['message_id']}", "file_unique_id": "bench", "width": 1, "height": 1}]
+        if method == "sendDocument":
+            msg["document"] = {"file_id": f"bench-{msg['message_id']}", "file_unique_id": "bench"}
+        markup = data.get("reply_markup")
+        if isinstance(markup, str):
+            markup = json.loads(markup)
+        elif hasattr(markup, "to_dict"):
+            markup = markup.to_dict()
+        self.last[chat_id] = dict(msg, reply_markup=markup)
+        if markup and "inline_keyboard" in markup:
+            self.inline[chat_id] = self.last[chat_id]
+        return msg
+
+    def stop(self):
+        pass
+
+fake = FakeRequest(args.api_latency / 1000)
+main.bot._request = fake
+
+# === UPDATES ===
+update_ids = itertools.count(1)
+
+def message_update(uid: int, text: str) -> dict:
+    return {"update_id": next(update_ids), "message": {
+        "message_id": next(update_ids), "date": int(time.time()), "text": text,
+        "chat": {"id": uid, "type": "private"},
+        "from": {"id": uid, "is_bot": False, "first_name": "Bench"}}}
+
+def callback_update(uid: int, data: str) -> dict:
+    last = fake.inline.get(uid) or fake.last.get(uid, {})
+    return {"update_id": next(update_ids), "callback_query": {
+        "id": str(next(update_ids)), "chat_instance": "bench", "data": data,
+        "from": {"id": uid, "is_bot": False, "first_name": "Bench"},
+        "message": {"message_id": last.get("message_id", 1), "date": int(time.time()),
+                    "chat": {"id": uid, "type": "private"}, "text": last.get("text", "")}}}
+
+def keyboard_labels(uid: int) -> list:
+    rows   = (fake.last.get(uid, {}).get("reply_markup") or {}).get("keyboard", [])
+    labels = [b if isinstance(b, str) else b["text"] for row in rows for b in row]
+    return [lbl for lbl in labels if lbl not in ("Новый поиск", "Назад")]
+
+# callback_data of the inline button with this text on the last message with inline buttons sent to uid
+def inline_data(uid: int, text: str):
+    rows = (fake.inline.get(uid, {}).get("reply_markup") or {}).get("inline_keyboard", [])
+    return next((b["callback_data"] for row in rows for b in row if b["text"] == text), None)
+
+def dispatch(payload: dict):
+    main.dispatcher.process_update(main.Update.de_json(payload, main.bot))
+
+# the dispatcher swallows handler exceptions, they are collected through an error handler;
+# a handler in a later group runs after handle_message (even when it raised) and stamps
+# when each timed webhook update was fully processed
+posted = {}      # update_id -> perf_counter when the timed update was posted
+done   = {}      # update_id -> perf_counter when the dispatcher finished it
+failed = set()   # update_ids whose handler raised
+
+def record_done(update, context):
+    if update.update_id in posted:
+        done[update.update_id] = time.perf_counter()
+
+def record_error(update, context):
+    if update is not None:
+        failed.add(update.update_id)
+
+main.dispatcher.add_handler(TypeHandler(main.Update, record_done), group=99)
+main.dispatcher.add_error_handler(record_error)
+
+# === FLOWS ===
+# each flow puts a fresh user in the right state with untimed updates and returns the payload to time;
+# a fresh uid per timed update keeps queued webhook updates from seeing another prelude's state
+fresh_uids = itertools.count(9_000_000)
+
+def users_where(pred) -> list:
+    return [uid for uid, info in main.ZONES_MAP.items() if pred(info)]
+
+def clone_user(uid: str) -> int:
+    new = next(fresh_uids)
+    main.ZONES_MAP[str(new)] = main.ZONES_MAP[uid]
+    return new
+
+def pick_meter(info: dict) -> str:
+    region = info["region"] if info["region"] in main.REES["data"] else rnd.choice(REGIONS)
+    df     = main.REES["data"][region]
+    if rnd.random() < 0.1:
+        return str(rnd.randint(10**10, 10**11))
+    return df[main.METER_COL].iat[rnd.randrange(len(df))]
+
+def pick_tp(info: dict) -> str:
+    df = main.VOLS["df"]
+    if info["region_tp"].upper() != "ALL":
+        df = df[df[main.VOLS_RES_COL] == info["region_tp"]]
+    return df[main.VOLS["tp_col"]].iat[rnd.randrange(len(df))].replace("ТП-", "")
+
+def prelude(uid: int, texts: list):
+    main.user_states[str(uid)] = {}
+    for t in texts:
+        dispatch(message_update(uid, t))
+
+def flow_menu(uid, info):
+    prelude(uid, [])
+    return message_update(uid, "Справка")
+
+def flow_help(uid, info):
+    prelude(uid, ["Справка"])
+    return message_update(uid, rnd.choice(list(main.HELP_IMAGES)))
+
+def flow_search(uid, info):
+    prelude(uid, ["Поиск по прибору учета"])
+    return message_update(uid, pick_meter(info))
+
+def flow_info(uid, info):
+    prelude(uid, ["Поиск по прибору учета", pick_meter(info)])
+    return message_update(uid, rnd.choice(list(main.INFO_COLS)))
+
+def flow_vols_tp_input(uid, info):
+    prelude(uid, ["ВОЛС", "Поиск по ТП"])
+    return message_update(uid, pick_tp(info))
+
+def flow_vols_provider_input(uid, info):
+    prelude(uid, ["ВОЛС", "Поиск по контрагенту"])
+    name = rnd.choice(PROVIDERS).lower()
+    i    = rnd.randrange(len(name))
+    return message_update(uid, name[i:i + rnd.randint(1, 6)])
+
+def flow_vols_tp_list(uid, info):
+    prelude(uid, ["ВОЛС", "Поиск по ТП", pick_tp(info)])
+    labels = keyboard_labels(uid)
+    return message_update(uid, rnd.choice(labels) if labels else "Назад")
+
+def flow_vols_page(uid, info):
+    payload = flow_vols_tp_list(uid, info)
+    dispatch(payload)
+    # single-page results have no buttons, re-request their only page
+    state = main.user_states.get(str(uid), {})
+    token = main.vols_token(state) if state.get("selected") else ""
+    return callback_update(uid, inline_data(uid, "▶") or f"vols:page:{token}:0")
+
+FLOWS = {
+    "menu":                flow_menu,
+    "help":                flow_help,
+    "search":              flow_search,
+    "info":                flow_info,
+    "vols_tp_input":       flow_vols_tp_input,
+    "vols_provider_input": flow_vols_provider_input,
+    "vols_tp_list":        flow_vols_tp_list,
+    "vols_page":           flow_vols_page,
+}
+
+def flow_users(name: str) -> list:
+    if name.startswith("vols"):
+        return users_where(lambda i: i["region_tp"])
+    if name in ("search", "info"):
+        return users_where(lambda i: i["region"])
+    return users_where(lambda i: True)
+
+# === REPORT ===
+def percentiles(latencies: list, prefix: str = "") -> dict:
+    ms = np.array(latencies) * 1000 if latencies else np.array([np.nan])
+    return {f"{prefix}p{p}_ms": round(float(np.percentile(ms, p)), 3) for p in (50, 95, 99)}
+
+def summarize(latencies: list, elapsed: float, ids: list) -> dict:
+    return dict({"n": len(latencies)}, **percentiles(latencies),
+                updates_per_s=round(len(latencies) / elapsed, 1) if elapsed else None,
+                errors=sum(1 for i in ids if i in failed))
+
+def print_table(title: str, rows: dict):
+    extra = [k for k in ("done_p50_ms", "done_p95_ms", "done_p99_ms") if any(k in r for r in rows.values())]
+    print(f"\n{title}")
+    print(f"{'flow':<22}{'n':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+          + "".join(f"{k[:-3].replace('_', ' ') + ' ms':>14}" for k in extra) + f"{'upd/s':>10}{'errors':>8}")
+    for name, r in rows.items():
+        print(f"{name:<22}{r['n']:>7}{r['p50_ms']:>10}{r['p95_ms']:>10}{r['p99_ms']:>10}"
+              + "".join(f"{r[k]:>14}" for k in extra) + f"{r['updates_per_s'] or '':>10}{r['errors']:>8}")
+
+def run_direct(streams: dict) -> dict:
+    results = {}
+    for name, payloads in streams.items():
+        latencies, ids, t_all = [], [], time.perf_counter()
+        for make in payloads:
+            payload = make()
+            ids.append(payload["update_id"])
+            t0 = time.perf_counter()
+            dispatch(payload)
+            latencies.append(time.perf_counter() - t0)
+        results[name] = summarize(latencies, time.perf_counter() - t_all, ids)
+    return results
+
+# p*_ms: /webhook request (parse, dedup, enqueue); done_p*_ms: request start until a worker
+# finished the update, i.e. including the time it waited in the queue
+def run_webhook(streams: dict) -> dict:
+    client, results = main.app.test_client(), {}
+    for name, payloads in streams.items():
+        # preludes run synchronously here, only the timed updates go through the queue
+        batch = [make() for make in payloads]
+        latencies, t_all = [], time.perf_counter()
+        for payload in batch:
+            t0 = posted[payload["update_id"]] = time.perf_counter()
+            client.post("/webhook", json=payload)
+            latencies.append(time.perf_counter() - t0)
+        for q in main.update_queues:
+            q.join()
+        ids = [p["update_id"] for p in batch]
+        results[name] = summarize(latencies, time.perf_counter() - t_all, ids)
+        results[name].update(percentiles([done[i] - posted[i] for i in ids if i in done], "done_"))
+    return results
+
+def load_replay(path: str) -> list:
+    with open(path, encoding="utf-8") as f:
+        updates = [json.loads(line) for line in f if line.strip()]
+    # recorded users get full access so every update reaches its handler
+    for u in updates:
+        sender = (u.get("message") or u.get("callback_query") or {}).get("from", {})
+        if sender.get("id") and str(sender["id"]) not in main.ZONES_MAP:
+            main.ZONES_MAP[str(sender["id"])] = {"region": "ALL", "name": "", "region_tp": "ALL"}
+    return updates
+
+# === RELOAD CHECK ===
+# typical sheet edits; every delta reload must give the same snapshot as building it from scratch
+EDITS = ["none", "edit", "edit_meters", "append", "delete", "insert", "mixed", "many", "columns"]
+EMPTY_VOLS = main.VOLS
+
+def edit_frame(df: pd.DataFrame, make, kind: str) -> pd.DataFrame:
+    n, k = len(df), max(len(df) // 50, 1)
+    df   = df.copy()
+    if kind in ("edit", "edit_meters", "mixed", "many"):
+        rows = rnd.sample(range(n), k if kind != "many" else n // 2)
+        df.iloc[rows] = make(len(rows)).to_numpy()
+        if kind == "edit_meters" and main.METER_COL in df.columns:
+            # move existing meter numbers between rows, including duplicates
+            df.iloc[rows, df.columns.get_loc(main.METER_COL)] = df[main.METER_COL].iloc[rnd.sample(range(n), len(rows))].to_numpy()
+    if kind in ("append", "mixed"):
+        df = pd.concat([df, make(k)], ignore_index=True)
+    if kind in ("delete", "mixed"):
+        at = rnd.randrange(len(df) - k)
+        df = df.drop(df.index[at:at + k])
+    if kind == "insert":
+        at = rnd.randrange(n)
+        df = pd.concat([df.iloc[:at], make(k), df.iloc[at:]], ignore_index=True)
+    if kind == "columns":
+        df["Примечание"] = ""
+    return df.reset_index(drop=True)
+
+def same_arrays(a: dict, b: dict) -> bool:
+    return a.keys() == b.keys() and all(np.array_equal(a[key], b[key]) for key in a)
+
+def same_region(a: dict, b: dict) -> bool:
+    return (a["version"] == b["version"] and a["columns"] == b["columns"] and list(a["keys"]) == list(b["keys"])
+            and a["index"] == b["index"] and a["views"].keys() == b["views"].keys()
+            and all(a["views"][l][0] == b["views"][l][0] and np.array_equal(a["views"][l][1], b["views"][l][1])
+                    for l in a["views"]))
+
+def same_vols(a: dict, b: dict) -> bool:
+    return (a["version"] == b["version"] and a["tp_col"] == b["tp_col"] and a["ngrams"] == b["ngrams"]
+            and all(same_arrays(a[name], b[name]) for name in ("tp_index", "res_index", "prov_rows", "keys")))
+
+def check_reload() -> bool:
+    region, ok = REGIONS[0], True
+    print(f"{'dataset':<8}{'edit':<13}{'delta ms':>10}{'full ms':>10}  result")
+    for kind in EDITS:
+        base = make_region(args.rows)
+        main.REES = {"data": {}, "regions": {}}
+        main.install_regions({region: base})
+        new = edit_frame(base, make_region, kind)
+        t0 = time.perf_counter()
+        summary = main.install_regions({region: new})[region]
+        t1 = time.perf_counter()
+        full = main.build_region(new, main.row_hashes(new))
+        t2 = time.perf_counter()
+        same = same_region(main.REES["regions"][region], full)
+        ok  &= same
+        print(f"{'REES':<8}{kind:<13}{(t1-t0)*1000:>10.1f}{(t2-t1)*1000:>10.1f}  {'ok' if same else 'MISMATCH'}: {summary}")
+    for kind in EDITS:
+        base = make_vols(args.vols_rows)
+        main.VOLS = EMPTY_VOLS
+        main.install_vols(base)
+        new = edit_frame(base, make_vols, kind)
+        t0 = time.perf_counter()
+        summary = main.install_vols(new)
+        t1 = time.perf_counter()
+        delta, main.VOLS = main.VOLS, EMPTY_VOLS
+        main.install_vols(new)
+        t2 = time.perf_counter()
+        same = same_vols(delta, main.VOLS)
+        ok  &= same
+        print(f"{'VOLS':<8}{kind:<13}{(t1-t0)*1000:>10.1f}{(t2-t1)*1000:>10.1f}  {'ok' if same else 'MISMATCH'}: {summary}")
+    return ok
+
+# === RUN ===
+def setup():
+    t0 = time.perf_counter()
+    main.install_regions({region: make_region(args.rows) for region in REGIONS})
+    main.install_vols(make_vols(args.vols_rows))
+    main.ZONES_MAP, main.ZONES_TS = main.parse_zones_csv(make_zones_csv(args.users)), time.time()
+    for key, url in main.HELP_IMAGES.values():
+        main.FILE_IDS[key] = {"url": url, "file_id": f"bench-{key}"}
+    print(f"data: {args.regions} regions x {args.rows} rows, VOLS {args.vols_rows} rows, "
+          f"{len(main.ZONES_MAP)} users, state {args.state}, built in {time.perf_counter()-t0:.1f}s")
+
+def build_streams() -> dict:
+    streams = {}
+    if args.replay:
+        updates = load_replay(args.replay)
+        streams["replay"] = [lambda u=u: dict(u, update_id=next(update_ids)) for u in updates]
+        return streams
+    names = [n for n in args.flows.split(",") if n] or list(FLOWS)
+    for name in names:
+        users = flow_users(name)
+        if not users:
+            continue
+        def make(name=name, users=users):
+            uid = clone_user(rnd.choice(users))
+            return FLOWS[name](uid, main.ZONES_MAP[str(uid)])
+        streams[name] = [make] * args.iterations
+    return streams
+
+if __name__ == "__main__":
+    if args.check_reload:
+        sys.exit(0 if check_reload() else 1)
+    setup()
+    report = {"handle_message": run_direct(build_streams())}
+    print_table("handle_message (dispatcher, synchronous)", report["handle_message"])
+    if not args.no_webhook:
+        report["webhook"] = run_webhook(build_streams())
+        print_table(f"/webhook (request and queued-to-done latency; upd/s until {args.workers} workers drained)", report["webhook"])
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    sys.exit(0)
@@ -1,12 +1,28 @@
 import os
+import time
 import threading
 import re
+import hashlib
+import pickle
+import queue
+import sys
+import json
+import sqlite3
+import bisect
+import functools
+import uuid
+import numpy as np
 import pandas as pd
 import requests
 from io import BytesIO, StringIO
-from flask import Flask, request
-from telegram import Bot, Update, ReplyKeyboardMarkup
-from telegram.ext import Dispatcher, CommandHandler, MessageHandler, Filters, CallbackContext
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from flask import Flask, Response, request, jsonify
+from telegram import Bot, Update, ReplyKeyboardMarkup, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram.error import TelegramError, RetryAfter, Unauthorized, BadRequest, ChatMigrated, NetworkError
+from telegram.ext import Dispatcher, CommandHandler, MessageHandler, CallbackQueryHandler, Filters, CallbackContext
+from telegram.utils.request import Request
 
 app = Flask(__name__)
 
@@ -19,8 +35,127 @@ REES_SHEETS_MAP = {
     for p in os.getenv("REES_SHEETS_MAP","").split(",") if p.strip()
 }
 VOLS_SHEETS_URL = os.getenv("VOLS_SHEETS_URL")
+LOAD_WORKERS    = int(os.getenv("LOAD_WORKERS", "8"))
+LOAD_TIMEOUT    = int(os.getenv("LOAD_TIMEOUT", "30"))
+SNAPSHOT_DIR    = os.getenv("SNAPSHOT_DIR", "snapshots")
+UPDATE_WORKERS  = int(os.getenv("UPDATE_WORKERS", "4"))
+UPDATE_QUEUE_MAX = int(os.getenv("UPDATE_QUEUE_MAX", "500"))
+BROADCAST_RATE  = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "8"))
+SESSION_TTL     = int(os.getenv("SESSION_TTL", str(12*3600)))
+SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", str(16*1024*1024)))
+HELP_CACHE_CHAT_ID = os.getenv("HELP_CACHE_CHAT_ID")
+VOLS_DOC_THRESHOLD = int(os.getenv("VOLS_DOC_THRESHOLD", "20"))
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+AUTO_WARMUP     = os.getenv("AUTO_WARMUP", "1") == "1"
+STATE_BACKEND   = os.getenv("STATE_BACKEND", "sqlite")
+STATE_DB_PATH   = os.getenv("STATE_DB_PATH", "state.db")
+REDIS_URL       = os.getenv("REDIS_URL", "redis://localhost:6379/0")
 
-bot        = Bot(token=TOKEN)
+# === METRICS ===
+# in-process Prometheus counters/histograms; every recording call returns immediately when METRICS_ENABLED is off
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+METRIC_HELP = {
+    "bot_handler_seconds":        "handle_message latency by branch",
+    "bot_telegram_api_seconds":   "Telegram Bot API call latency by method",
+    "bot_webhook_requests_total": "webhook requests by result",
+    "bot_update_errors_total":    "updates that raised while being processed",
+}
+_counters     = {}   # (name, labels) -> value
+_histograms   = {}   # (name, labels) -> [bucket counts..., sum, count]
+_metrics_lock = threading.Lock()
+
+def inc(name: str, value: float = 1, **labels):
+    if not METRICS_ENABLED:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _metrics_lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def observe(name: str, value: float, **labels):
+    if not METRICS_ENABLED:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _metrics_lock:
+        h = _histograms.get(key)
+        if h is None:
+            h = _histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+        h[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        h[-2] += value
+        h[-1] += 1
+
+# handle_message records which branch served the update through set_branch
+_branch = threading.local()
+
+def set_branch(name: str):
+    _branch.name = name
+
+def timed_handler(fn):
+    @functools.wraps(fn)
+    def wrapper(update, context):
+        if not METRICS_ENABLED:
+            return fn(update, context)
+        _branch.name = "menu"
+        t0 = time.perf_counter()
+        try:
+            return fn(update, context)
+        finally:
+            observe("bot_handler_seconds", time.perf_counter() - t0, branch=_branch.name)
+    return wrapper
+
+class InstrumentedBot(Bot):
+    def _post(self, endpoint, *args, **kwargs):
+        if not METRICS_ENABLED:
+            return super()._post(endpoint, *args, **kwargs)
+        t0, status = time.perf_counter(), "ok"
+        try:
+            return super()._post(endpoint, *args, **kwargs)
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            observe("bot_telegram_api_seconds", time.perf_counter() - t0, method=endpoint, status=status)
+
+def format_labels(labels) -> str:
+    if not labels:
+        return ""
+    def esc(v):
+        return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in labels) + "}"
+
+# gauges are (name, help, [(labels, value), ...]) computed by the caller at scrape time
+def render_metrics(gauges: list) -> str:
+    with _metrics_lock:
+        counters   = dict(_counters)
+        histograms = {k: list(v) for k, v in _histograms.items()}
+    out, described = [], set()
+    def describe(name, kind, text):
+        if name not in described:
+            described.add(name)
+            out.append(f"# HELP {name} {text}")
+            out.append(f"# TYPE {name} {kind}")
+    for (name, labels), value in sorted(counters.items()):
+        describe(name, "counter", METRIC_HELP.get(name, name))
+        out.append(f"{name}{format_labels(labels)} {value}")
+    for (name, labels), h in sorted(histograms.items()):
+        describe(name, "histogram", METRIC_HELP.get(name, name))
+        cumulative = 0
+        for bound, n in zip(LATENCY_BUCKETS + (float("inf"),), h[:-2]):
+            cumulative += n
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            out.append(f"{name}_bucket{format_labels(labels + (('le', le),))} {cumulative}")
+        out.append(f"{name}_sum{format_labels(labels)} {h[-2]}")
+        out.append(f"{name}_count{format_labels(labels)} {h[-1]}")
+    for name, text, samples in gauges:
+        describe(name, "gauge", text)
+        for labels, value in samples:
+            out.append(f"{name}{format_labels(labels)} {value}")
+    return "\n".join(out) + "\n"
+
+# update workers and broadcast senders call the Bot API concurrently; the default pool of one
+# connection would make most of them open (and then discard) a fresh TLS connection.
+# The extra connections cover reload reports, image prefetch and the webhook setup.
+bot        = InstrumentedBot(token=TOKEN, request=Request(con_pool_size=UPDATE_WORKERS + BROADCAST_WORKERS + 4))
 dispatcher = Dispatcher(bot, None, use_context=True)
 
 # === HELP IMAGES ===
@@ -28,6 +163,11 @@ BASE_DRIVE_URL      = "https://drive.google.com/uc?export=download&id="
 IMG_FORMULAS_URL    = BASE_DRIVE_URL + "1StUq8JSdpwU1QvJJ6F3W3dHZnReF6kt8"
 IMG_CABLE_URL       = BASE_DRIVE_URL + "11LaH-BvqtUPj2wTQ31wl-1Qrs2aRGb0I"
 IMG_SELECTIVITY_URL = BASE_DRIVE_URL + "11q0orVtOJ_UTk5UVLEn5yGUOeCsWQkaX"
+HELP_IMAGES = {
+    "Сечение кабеля (ток, мощность)": ("cable",       IMG_CABLE_URL),
+    "Селективность (ток, мощность)":  ("selectivity", IMG_SELECTIVITY_URL),
+    "Формулы":                        ("formulas",    IMG_FORMULAS_URL),
+}
 
 # === HELPERS ===
 def make_export_url(raw_url: str) -> str:
@@ -40,56 +180,558 @@ def make_export_url(raw_url: str) -> str:
         return f"https://docs.google.com/spreadsheets/d/{m.group(1)}/export?format=xlsx"
     return raw_url
 
-# === CACHE REES SHEETS ===
-DATA_CACHE = {}
-def refresh_cache():
-    for region, raw_url in REES_SHEETS_MAP.items():
+# === HTTP LOADER ===
+HTTP = requests.Session()
+HTTP.mount("https://", HTTPAdapter(pool_connections=LOAD_WORKERS, pool_maxsize=LOAD_WORKERS))
+HTTP.mount("http://",  HTTPAdapter(pool_connections=LOAD_WORKERS, pool_maxsize=LOAD_WORKERS))
+
+# url -> validators of the last successfully parsed download
+SOURCE_META = {}
+# dataset name -> time the data was last confirmed current (parsed or not modified)
+DATASET_TS  = {}
+# dataset name -> seconds the last download (and parse) took
+LOAD_SECONDS = {}
+
+# returns (content, meta); content is None when the source has not changed since the last parse.
+# meta must be stored in SOURCE_META by the caller only after the content was parsed successfully.
+def fetch_source(name: str, url: str):
+    meta    = SOURCE_META.get(url, {})
+    headers = {}
+    if meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
+    t0 = time.time()
+    r  = HTTP.get(url, headers=headers, timeout=LOAD_TIMEOUT)
+    if r.status_code == 304:
+        print(f"[load] {name}: not modified ({time.time()-t0:.2f}s)")
+        return None, meta
+    r.raise_for_status()
+    new_meta = {
+        "etag":          r.headers.get("ETag"),
+        "last_modified": r.headers.get("Last-Modified"),
+        "sha1":          hashlib.sha1(r.content).hexdigest(),
+    }
+    unchanged = new_meta["sha1"] == meta.get("sha1")
+    print(f"[load] {name}: {len(r.content)} bytes in {time.time()-t0:.2f}s{' (unchanged)' if unchanged else ''}")
+    return (None if unchanged else r.content), new_meta
+
+def load_sheet(name: str, raw_url: str):
+    url = make_export_url(raw_url)
+    start = time.time()
+    content, meta = fetch_source(name, url)
+    if content is None:
+        DATASET_TS[name]   = time.time()
+        LOAD_SECONDS[name] = DATASET_TS[name] - start
+        return None
+    t0 = time.time()
+    df = pd.read_excel(BytesIO(content), dtype=str)
+    print(f"[load] {name}: parsed {len(df)} rows in {time.time()-t0:.2f}s")
+    SOURCE_META[url] = meta
+    DATASET_TS[name]   = time.time()
+    LOAD_SECONDS[name] = DATASET_TS[name] - start
+    try:
+        STATE.set_meta(f"source:{url}", dict(meta, fetched_at=DATASET_TS[name]))
+    except Exception as e:
+        print(f"[state] Error saving version of {name}: {e}")
+    try:
+        save_snapshot(name, url, df, meta)
+    except Exception as e:
+        print(f"[snapshot] Error saving {name}: {e}")
+    return df
+
+# === LOCAL SNAPSHOTS ===
+# parsed sheets are pickled to SNAPSHOT_DIR so a restart does not wait for the xlsx download and parse
+SNAPSHOT_MAGIC = b"TGBOT-SNAPSHOT 1\n"
+
+def snapshot_path(name: str) -> str:
+    return os.path.join(SNAPSHOT_DIR, re.sub(r"[^\w-]", "_", name) + ".pkl")
+
+def save_snapshot(name: str, url: str, df: pd.DataFrame, meta: dict):
+    if not SNAPSHOT_DIR:
+        return
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    path = snapshot_path(name)
+    tmp  = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(SNAPSHOT_MAGIC)
+        pickle.dump({"name": name, "url": url, "fetched_at": DATASET_TS[name], "meta": meta, "df": df},
+                    f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+# returns the snapshot dict, or None when it is missing, from another format or from another source url
+def load_snapshot(name: str, url: str):
+    if not SNAPSHOT_DIR:
+        return None
+    try:
+        with open(snapshot_path(name), "rb") as f:
+            if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+                return None
+            snap = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"[snapshot] Error reading {name}: {e}")
+        return None
+    return snap if snap.get("url") == url else None
+
+def restore_snapshot(name: str, raw_url: str):
+    url  = make_export_url(raw_url)
+    snap = load_snapshot(name, url)
+    if snap is None:
+        return None
+    # keep the validators so the first network refresh can skip the parse
+    SOURCE_META[url] = snap["meta"]
+    DATASET_TS[name] = snap["fetched_at"]
+    print(f"[snapshot] {name}: {len(snap['df'])} rows from {time.ctime(snap['fetched_at'])}")
+    return snap["df"]
+
+# === HELP IMAGE CACHE ===
+# help images are uploaded to Telegram once and re-sent by file_id instead of making Telegram fetch them from Drive
+FILE_IDS_PATH = os.path.join(SNAPSHOT_DIR or ".", "file_ids.json")
+FILE_IDS      = {}   # image key -> {"url": source url, "file_id": telegram file_id}
+IMAGE_BYTES   = {}   # image key -> downloaded image
+_file_ids_lock = threading.Lock()
+
+def load_file_ids():
+    global FILE_IDS
+    try:
+        with open(FILE_IDS_PATH, encoding="utf-8") as f:
+            FILE_IDS = json.load(f)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"[images] Error reading {FILE_IDS_PATH}: {e}")
+
+def set_file_id(key: str, url: str, file_id):
+    with _file_ids_lock:
+        if file_id:
+            FILE_IDS[key] = {"url": url, "file_id": file_id}
+        else:
+            FILE_IDS.pop(key, None)
+        try:
+            os.makedirs(os.path.dirname(FILE_IDS_PATH) or ".", exist_ok=True)
+            tmp = f"{FILE_IDS_PATH}.{os.getpid()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(FILE_IDS, f)
+            os.replace(tmp, FILE_IDS_PATH)
+        except Exception as e:
+            print(f"[images] Error saving {FILE_IDS_PATH}: {e}")
+
+def cached_file_id(key: str, url: str):
+    entry = FILE_IDS.get(key)
+    return entry["file_id"] if entry and entry.get("url") == url else None
+
+def image_bytes(key: str, url: str) -> bytes:
+    if key not in IMAGE_BYTES:
+        r = HTTP.get(url, timeout=LOAD_TIMEOUT); r.raise_for_status()
+        IMAGE_BYTES[key] = r.content
+    return IMAGE_BYTES[key]
+
+def send_help_image(message, txt: str):
+    key, url = HELP_IMAGES[txt]
+    file_id = cached_file_id(key, url)
+    if file_id:
+        try:
+            return message.reply_photo(photo=file_id)
+        except BadRequest as e:
+            print(f"[images] {key}: cached file_id rejected ({e}), uploading again")
+            set_file_id(key, url, None)
+    try:
+        photo = image_bytes(key, url)
+    except Exception as e:
+        print(f"[images] Error downloading {key}: {e}")
+        photo = url
+    sent = message.reply_photo(photo=photo)
+    if sent.photo:
+        set_file_id(key, url, sent.photo[-1].file_id)
+    return sent
+
+# downloads the images and, if HELP_CACHE_CHAT_ID is set, uploads them there to get file_ids before first use
+def prefetch_help_images():
+    for key, url in HELP_IMAGES.values():
         try:
-            url = make_export_url(raw_url)
-            r   = requests.get(url, timeout=10); r.raise_for_status()
-            DATA_CACHE[region] = pd.read_excel(BytesIO(r.content), dtype=str)
+            data = image_bytes(key, url)
+            if HELP_CACHE_CHAT_ID and not cached_file_id(key, url):
+                sent = bot.send_photo(chat_id=HELP_CACHE_CHAT_ID, photo=data, disable_notification=True)
+                set_file_id(key, url, sent.photo[-1].file_id)
         except Exception as e:
-            print(f"[cache] Error loading {region}: {e}")
-    t = threading.Timer(3600, refresh_cache); t.daemon=True; t.start()
+            print(f"[images] Error prefetching {key}: {e}")
+
+load_file_ids()
+
+# === CACHE REES SHEETS ===
+METER_COL = "Номер счетчика"
+
+INFO_COLS = {
+    "Информация по договору": ["Номер счетчика","ТУ","Номер ТУСТЕК","Номер ТУ","ЛС / ЛС СТЕК","Наименование договора","Вид потребителя","Субабонент"],
+    "Информация по подключению": ["Номер счетчика","Сетевой участок","Населенный пункт","Улица","Дом","Подстанция","Фидер10","ТП"],
+    "Информация по прибору учета": [
+        "Номер счетчика","Максимальная мощность","Вид счетчика","Фазность",
+        "Госповерка счетчика","Межповерочный интервал ПУ","Окончание срок поверки",
+        "Проверка схемы дата","Последнее активное событие дата",
+        "Тип ТТ","Первичный ток ТТ",
+        "Заводской номер ТТ (А)","Заводской номер ТТ (В)","Заводской номер ТТ (С)",
+        "Госповерка ТТ","Межповерочный интервал ТТ","Окончание срок поверки ТТ",
+        "Тип ТН","Заводской номер ТН","Госповерка ТН",
+        "Межповерочный интервал ТН","Окончание срок поверки ТН"
+    ],
+}
+
+# Published snapshot of all regions. It is never modified after publication: a reload builds a new
+# dict and swaps the global in one assignment, so a handler that reads REES once sees one consistent
+# version of sheets, indexes and views.
+#   data:    region -> DataFrame
+#   regions: region -> {"version": content_version of the rows, "columns", "keys": normalized meter per row,
+#                       "index": normalized meter -> [row positions],
+#                       "views": {info button: (columns, row-aligned values)}, "hashes": row hashes}
+REES = {"data": {}, "regions": {}}
+_rees_lock = threading.RLock()
+
+def normalize_meter(number: str) -> str:
+    return str(number).strip().lstrip("0") or "0"
+
+# normalized meter number per row, "" for rows without one
+def meter_keys(df: pd.DataFrame) -> list:
+    if METER_COL not in df.columns:
+        return [""] * len(df)
+    raw = df[METER_COL].fillna("").astype(str).str.strip()
+    return raw.str.lstrip("0").mask(lambda s: s == "", "0").where(raw != "", "").tolist()
+
+def row_hashes(df: pd.DataFrame) -> np.ndarray:
+    return pd.util.hash_pandas_object(df, index=False).to_numpy()
+
+# Sessions are shared between workers and survive restarts, so row handles kept in them are keyed
+# by the sheet contents: equal on every process that loaded the same rows, unlike a local counter.
+def content_version(hashes: np.ndarray) -> str:
+    return hashlib.sha1(hashes.tobytes()).hexdigest()[:16]
+
+def build_info_views(df: pd.DataFrame) -> dict:
+    views = {}
+    for label, cols in INFO_COLS.items():
+        cols = [c for c in cols if c in df.columns]
+        views[label] = (cols, df[cols].to_numpy(dtype=object))
+    return views
+
+# key -> [row positions], rows without a key are left out
+def group_positions(keys) -> dict:
+    index = {}
+    for pos, key in enumerate(keys):
+        if key:
+            index.setdefault(key, []).append(pos)
+    return index
+
+def build_region(df: pd.DataFrame, hashes: np.ndarray) -> dict:
+    keys = np.array(meter_keys(df), dtype=object)
+    return {"version": content_version(hashes), "columns": list(df.columns), "keys": keys,
+            "index": group_positions(keys), "views": build_info_views(df), "hashes": hashes}
+
+# How a reloaded sheet lines up with the previous one: runs of (new start, old start, length) that
+# can be copied from the old row-aligned arrays, and the new positions of rows that are new or changed.
+# With the same length rows are compared in place (the single run also covers the changed rows, they
+# are overwritten afterwards); otherwise the unchanged leading and trailing rows are matched, which
+# covers rows appended at the end and a block inserted or deleted in between.
+def align_rows(old_hashes: np.ndarray, hashes: np.ndarray):
+    n_old, n = len(old_hashes), len(hashes)
+    if n_old == n:
+        return [(0, 0, n)], np.flatnonzero(hashes != old_hashes)
+    m    = min(n_old, n)
+    diff = np.flatnonzero(hashes[:m] != old_hashes[:m])
+    head = int(diff[0]) if len(diff) else m
+    diff = np.flatnonzero(hashes[::-1][:m - head] != old_hashes[::-1][:m - head])
+    tail = int(diff[0]) if len(diff) else m - head
+    return [(0, 0, head), (n - tail, n_old - tail, tail)], np.arange(head, n - tail)
+
+# row-aligned array of the new sheet: kept runs are sliced from the old array, changed rows come from fresh
+def realign(old_values: np.ndarray, runs: list, changed: np.ndarray, fresh) -> np.ndarray:
+    n      = runs[-1][0] + runs[-1][2]   # the last run ends at the new length
+    values = np.empty((n,) + old_values.shape[1:], dtype=object)
+    for new_at, old_at, size in runs:
+        values[new_at:new_at + size] = old_values[old_at:old_at + size]
+    values[changed] = fresh
+    return values
+
+def reload_summary(n_old: int, n: int, changed: int) -> str:
+    if n_old == n:
+        return f"изменено строк: {changed}"
+    return f"строк было {n_old}, стало {n}, перечитано: {changed}"
+
+# returns (region part, summary); only new or changed rows are read from the sheet again,
+# the rest of the keys and info views is copied over from the old part
+def diff_region(old_part, df: pd.DataFrame):
+    hashes = row_hashes(df)
+    if old_part is None or old_part["columns"] != list(df.columns):
+        return build_region(df, hashes), f"загружено заново ({len(df)} строк)"
+    n_old   = len(old_part["hashes"])
+    runs, changed = align_rows(old_part["hashes"], hashes)
+    if not len(changed) and n_old == len(df):
+        return old_part, "без изменений"
+    summary = reload_summary(n_old, len(df), len(changed))
+    if len(changed) > len(df) // 4:
+        return build_region(df, hashes), f"{summary}, индекс перестроен"
+    fresh = df.iloc[changed]
+    keys  = realign(old_part["keys"], runs, changed, meter_keys(fresh))
+    views = {label: (cols, realign(values, runs, changed, fresh[cols].to_numpy(dtype=object)))
+             for label, (cols, values) in old_part["views"].items()}
+    if n_old != len(df):
+        # rows after an inserted or deleted block moved, regroup from the cached keys
+        index = group_positions(keys)
+    else:
+        # copy-on-write: the old snapshot's lists are replaced, never mutated
+        index = dict(old_part["index"])
+        for pos, old_key, new_key in zip(changed.tolist(), old_part["keys"][changed], keys[changed]):
+            if old_key == new_key:
+                continue
+            if old_key:
+                rest = [p for p in index[old_key] if p != pos]
+                if rest:
+                    index[old_key] = rest
+                else:
+                    del index[old_key]
+            if new_key:
+                index[new_key] = sorted(index.get(new_key, []) + [pos])
+    part = {"version": content_version(hashes), "columns": old_part["columns"], "keys": keys,
+            "index": index, "views": views, "hashes": hashes}
+    return part, summary
+
+# merges newly loaded regions into a new snapshot and publishes it; returns region -> summary
+def install_regions(frames: dict) -> dict:
+    global REES
+    with _rees_lock:
+        old = REES
+        data, regions, report = dict(old["data"]), dict(old["regions"]), {}
+        for region, df in frames.items():
+            part, report[region] = diff_region(old["regions"].get(region), df)
+            if part is not old["regions"].get(region):
+                data[region], regions[region] = df, part
+        order = [r for r in REES_SHEETS_MAP if r in data] + [r for r in data if r not in REES_SHEETS_MAP]
+        REES  = {"data": {r: data[r] for r in order}, "regions": {r: regions[r] for r in order}}
+        for region in frames:
+            others = [p["index"] for r, p in regions.items() if r != region]
+            dups   = sum(1 for key in regions[region]["index"] if any(key in o for o in others))
+            if dups:
+                print(f"[cache] {region}: {dups} meter number(s) also found in other regions")
+        return report
+
+# [(region, row position), ...] for a meter number over all regions of a snapshot
+def meter_hits(rees: dict, number: str) -> list:
+    key = normalize_meter(number)
+    return [(region, pos) for region, part in rees["regions"].items() for pos in part["index"].get(key, ())]
+
+def refresh_cache():
+    # the hourly timer, sync_versions and admin reloads may overlap
+    with _rees_lock:
+        frames = {}
+        with ThreadPoolExecutor(max_workers=LOAD_WORKERS) as pool:
+            futures = {region: pool.submit(load_sheet, region, raw_url) for region, raw_url in REES_SHEETS_MAP.items()}
+        for region, fut in futures.items():
+            try:
+                df = fut.result()
+            except Exception as e:
+                print(f"[cache] Error loading {region}: {e}")
+                continue
+            if df is not None:
+                frames[region] = df
+        if frames:
+            for region, summary in install_regions(frames).items():
+                print(f"[cache] {region}: {summary}")
+
+def cache_timer():
+    # reschedule even if the refresh raised, otherwise REES would never refresh again
+    try:
+        refresh_cache()
+    finally:
+        t = threading.Timer(3600, cache_timer); t.daemon=True; t.start()
 
 # === CACHE VOLS DATA ===
-VOLS_DF     = pd.DataFrame()
-VOLS_TP_COL = None
+VOLS_PROV_COL = "Наименование контрагента (собственника ВОЛС)"
+VOLS_RES_COL  = "РЭС"
+VOLS_NGRAM    = 3
+VOLS_QUERY_MAX = 100
+NO_ROWS       = np.array([], dtype=np.intp)
+
+# Published VOLS snapshot, swapped as a whole like REES so the frame, its TP column and
+# its indexes always belong together.
+#   tp_index:  "ТП-123" -> row positions
+#   res_index: РЭС -> row positions
+#   prov_rows: lowercased contractor name -> row positions
+#   ngrams:    1..VOLS_NGRAM-char substring -> set of lowercased contractor names
+#   keys:      index name -> its lookup key per row, hashes: row hashes (both for the next delta reload)
+VOLS = {"version": "", "df": pd.DataFrame(), "tp_col": None, "tp_index": {}, "res_index": {},
+        "prov_rows": {}, "ngrams": {}, "keys": {}, "hashes": None}
+_vols_lock = threading.RLock()
+
+def normalize_tp(txt: str) -> str:
+    tp = txt.strip().upper()
+    return tp if tp.startswith("ТП-") else f"ТП-{tp}"
+
+# value -> positional row ids
+def column_index(values: np.ndarray) -> dict:
+    return pd.Series(values).groupby(values).indices
+
+# copy-on-write: value -> positional row ids with rows moved from their old values to their new ones
+def patch_index(index: dict, rows: np.ndarray, old_values, new_values) -> dict:
+    moves = {}
+    for pos, a, b in zip(rows.tolist(), old_values, new_values):
+        if a != b:
+            moves.setdefault(a, ([], []))[1].append(pos)
+            moves.setdefault(b, ([], []))[0].append(pos)
+    if not moves:
+        return index
+    index = dict(index)
+    for key, (added, removed) in moves.items():
+        # groups are small, python sets beat numpy's set routines here
+        positions = sorted(set(index.get(key, NO_ROWS).tolist()).difference(removed).union(added))
+        if positions:
+            index[key] = np.array(positions, dtype=np.intp)
+        else:
+            index.pop(key, None)
+    return index
+
+# per-row lookup key of each VOLS index
+def vols_keys(df: pd.DataFrame, tp_col) -> dict:
+    def col(c):
+        return df[c].astype(str) if c in df.columns else pd.Series("", index=df.index)
+    return {
+        "tp_index":  col(tp_col).str.upper().str.strip().to_numpy(dtype=object),
+        "res_index": col(VOLS_RES_COL).str.strip().to_numpy(dtype=object),
+        "prov_rows": col(VOLS_PROV_COL).str.lower().to_numpy(dtype=object),
+    }
+
+def name_grams(name: str):
+    for n in range(1, VOLS_NGRAM + 1):
+        for i in range(len(name) - n + 1):
+            yield name[i:i+n]
+
+def build_ngrams(names) -> dict:
+    grams = {}
+    for name in names:
+        for g in name_grams(name):
+            grams.setdefault(g, set()).add(name)
+    return grams
+
+# copy-on-write update of the n-gram index for contractors that appeared or disappeared
+def patch_ngrams(grams: dict, added: set, removed: set) -> dict:
+    delta = {}
+    for i, names in enumerate((added, removed)):
+        for name in names:
+            for g in name_grams(name):
+                delta.setdefault(g, (set(), set()))[i].add(name)
+    grams = dict(grams)
+    for g, (plus, minus) in delta.items():
+        names = (grams.get(g, set()) - minus) | plus
+        if names:
+            grams[g] = names
+        else:
+            grams.pop(g, None)
+    return grams
+
+# builds and publishes a new VOLS snapshot; returns a summary of what changed.
+# Like diff_region, only new or changed rows are read again when at most a quarter changed.
+def install_vols(df: pd.DataFrame) -> str:
+    global VOLS
+    with _vols_lock:
+        old    = VOLS
+        df     = df.fillna("")
+        hashes = row_hashes(df)
+        n_old  = len(old["df"])
+        tp_col = next((c for c in df.columns if "тп" in c.lower()), old["tp_col"])
+        delta  = old["hashes"] is not None and list(df.columns) == list(old["df"].columns)
+        if delta:
+            runs, changed = align_rows(old["hashes"], hashes)
+            if not len(changed) and n_old == len(df):
+                return "без изменений"
+            summary = reload_summary(n_old, len(df), len(changed))
+            delta   = len(changed) <= len(df) // 4
+        else:
+            summary = f"загружено заново ({len(df)} строк)"
+        if delta:
+            fresh = vols_keys(df.iloc[changed], tp_col)
+            keys  = {name: realign(old["keys"][name], runs, changed, fresh[name]) for name in fresh}
+        else:
+            keys  = vols_keys(df, tp_col)
+        if delta and n_old == len(df):
+            indexes = {name: patch_index(old[name], changed, old["keys"][name][changed], keys[name][changed]) for name in keys}
+        else:
+            # full load, or rows after an inserted or deleted block moved: regroup from the keys
+            indexes = {name: column_index(values) for name, values in keys.items()}
+        prov_rows = indexes["prov_rows"]
+        added, removed = set(prov_rows) - set(old["prov_rows"]), set(old["prov_rows"]) - set(prov_rows)
+        if old["prov_rows"] and len(added) + len(removed) <= len(prov_rows) // 10:
+            ngrams = patch_ngrams(old["ngrams"], added, removed)
+        else:
+            ngrams = build_ngrams(prov_rows)
+        VOLS = {
+            "version":   content_version(hashes),
+            "df":        df,
+            "tp_col":    tp_col,
+            "tp_index":  indexes["tp_index"],
+            "res_index": indexes["res_index"],
+            "prov_rows": prov_rows,
+            "ngrams":    ngrams,
+            "keys":      keys,
+            "hashes":    hashes,
+        }
+        return summary
+
+# row positions whose contractor name contains query as a plain substring
+def search_providers(vols: dict, query: str) -> np.ndarray:
+    if not query:
+        names = list(vols["prov_rows"])
+    else:
+        n     = min(len(query), VOLS_NGRAM)
+        sets  = sorted((vols["ngrams"].get(query[i:i+n], set()) for i in range(len(query) - n + 1)), key=len)
+        names = [name for name in sets[0].intersection(*sets[1:]) if query in name]
+    if not names:
+        return NO_ROWS
+    return np.sort(np.concatenate([vols["prov_rows"][name] for name in names]))
+
+def filter_res(vols: dict, rows: np.ndarray, region_tp: str) -> np.ndarray:
+    if region_tp.upper() == "ALL":
+        return rows
+    return np.intersect1d(rows, vols["res_index"].get(region_tp, NO_ROWS))
+
 def refresh_vols():
-    global VOLS_DF, VOLS_TP_COL
+    with _vols_lock:
+        try:
+            df = load_sheet("VOLS", VOLS_SHEETS_URL)
+            if df is not None:
+                print(f"[cache] VOLS: {install_vols(df)}")
+        except Exception as e:
+            print(f"[cache] Error loading VOLS: {e}")
+
+def vols_timer():
     try:
-        url = make_export_url(VOLS_SHEETS_URL)
-        r   = requests.get(url, timeout=10); r.raise_for_status()
-        df  = pd.read_excel(BytesIO(r.content), dtype=str).fillna("")
-        for c in df.columns:
-            if "тп" in c.lower():
-                VOLS_TP_COL = c
-                break
-        VOLS_DF = df
-    except Exception as e:
-        print(f"[cache] Error loading VOLS: {e}")
-    t = threading.Timer(3600, refresh_vols); t.daemon=True; t.start()
+        refresh_vols()
+    finally:
+        t = threading.Timer(3600, vols_timer); t.daemon=True; t.start()
 
-refresh_cache()
-refresh_vols()
+# loads one dataset now instead of waiting for the hourly timer; returns a summary for the admin
+def reload_dataset(name: str) -> str:
+    if name == "VOLS":
+        with _vols_lock:
+            df = load_sheet("VOLS", VOLS_SHEETS_URL)
+            return "без изменений" if df is None else install_vols(df)
+    with _rees_lock:
+        df = load_sheet(name, REES_SHEETS_MAP[name])
+        return "без изменений" if df is None else install_regions({name: df})[name]
 
 # === LOAD ZONES CSV (strip headers + force strings) ===
+ZONES_TTL = int(os.getenv("ZONES_TTL", "300"))
+
 def load_zones_map():
-    r = requests.get(ZONES_CSV_URL, timeout=10); r.raise_for_status()
-    df = pd.read_csv(StringIO(r.content.decode("utf-8-sig")), dtype=str).fillna("")
+    r = HTTP.get(ZONES_CSV_URL, timeout=10); r.raise_for_status()
+    return parse_zones_csv(r.content.decode("utf-8-sig"))
+
+def parse_zones_csv(text: str) -> dict:
+    df = pd.read_csv(StringIO(text), dtype=str).fillna("")
 
     # strip whitespace/BOM from column names
     df.columns = df.columns.str.strip()
 
-    # ensure Region column is trimmed
-    if "Region" in df.columns:
-        df["Region"] = df["Region"].astype(str).str.strip()
-
     # find Region_TP as any header containing "тп"
     tp_cols = [c for c in df.columns if "тп" in c.lower()]
     region_tp_col = tp_cols[0] if tp_cols else None
-    if region_tp_col:
-        df[region_tp_col] = df[region_tp_col].astype(str).str.strip()
 
     # detect user name column
     if "Name" in df.columns:
@@ -101,17 +743,123 @@ def load_zones_map():
     else:
         name_col = None
 
-    zones = {}
-    for _, row in df.iterrows():
-        uid = str(row.get("ID","")).strip()
-        if not uid:
-            continue
-        zones[uid] = {
-            "region":    row.get("Region","").strip(),
-            "name":      row.get(name_col,"").strip() if name_col else "",
-            "region_tp": row.get(region_tp_col,"").strip() if region_tp_col else ""
-        }
-    return zones
+    def col(c):
+        if c and c in df.columns:
+            return df[c].astype(str).str.strip()
+        return pd.Series("", index=df.index, dtype=str)
+
+    zones = pd.DataFrame({
+        "region":    col("Region").values,
+        "name":      col(name_col).values,
+        "region_tp": col(region_tp_col).values,
+    }, index=col("ID").values)
+    zones = zones[zones.index != ""]
+    # last row wins for duplicate IDs
+    zones = zones[~zones.index.duplicated(keep="last")]
+    return zones.to_dict("index")
+
+# === CACHE ZONES MAP ===
+ZONES_MAP   = None
+ZONES_TS    = 0.0
+_zones_lock = threading.Lock()
+
+def _load_zones():
+    global ZONES_MAP, ZONES_TS
+    try:
+        zones = load_zones_map()
+        # swap the whole dict at once, readers never see a partial map
+        ZONES_MAP, ZONES_TS = zones, time.time()
+        DATASET_TS["ZONES"] = ZONES_TS
+    except Exception as e:
+        print(f"[zones] Error loading zones: {e}")
+
+def refresh_zones():
+    with _zones_lock:
+        _load_zones()
+
+# starts one background refresh unless one is already running
+def refresh_zones_async():
+    if not _zones_lock.acquire(blocking=False):
+        return
+    def run():
+        try:
+            _load_zones()
+        finally:
+            _zones_lock.release()
+    threading.Thread(target=run, daemon=True).start()
+
+def zones_timer():
+    try:
+        refresh_zones()
+        sync_versions()
+    finally:
+        t = threading.Timer(ZONES_TTL, zones_timer); t.daemon=True; t.start()
+
+# cached uid -> info map, None while the first load is still running;
+# the last good copy is served if a refresh fails. Retries never block the caller:
+# a slow or unreachable CSV host must not stall the update workers.
+def get_zones():
+    # None: warmup failed earlier, the caller answers LOADING_TEXT meanwhile;
+    # stale: the timer fell behind (e.g. the host slept)
+    if ZONES_MAP is None or time.time() - ZONES_TS > 2 * ZONES_TTL:
+        refresh_zones_async()
+    return ZONES_MAP
+
+# another worker or node may have loaded a newer sheet (hourly timers drift, admin reloads);
+# the shared content hash tells us to refresh now instead of at our own next timer
+_sync_lock = threading.Lock()
+
+def sync_versions():
+    # only datasets this process already holds can be stale; the first load (or a source whose
+    # fetch keeps failing here) is left to the regular timers instead of re-downloading everything
+    def stale(name, raw_url):
+        url   = make_export_url(raw_url)
+        local = SOURCE_META.get(url, {}).get("sha1")
+        if not local:
+            return False
+        try:
+            shared = STATE.get_meta(f"source:{url}")
+        except Exception as e:
+            print(f"[state] Error reading versions: {e}")
+            return False
+        return (bool(shared) and shared.get("sha1") != local
+                and shared.get("fetched_at", 0) > DATASET_TS.get(name, 0))
+    sources = dict(REES_SHEETS_MAP, **({"VOLS": VOLS_SHEETS_URL} if VOLS_SHEETS_URL else {}))
+    names   = [name for name, url in sources.items() if stale(name, url)]
+    if not names or not _sync_lock.acquire(blocking=False):
+        return
+    def run():
+        try:
+            for name in names:
+                try:
+                    print(f"[sync] {name}: {reload_dataset(name)}")
+                except Exception as e:
+                    print(f"[sync] Error reloading {name}: {e}")
+        finally:
+            _sync_lock.release()
+    threading.Thread(target=run, daemon=True).start()
+
+# === WARMUP ===
+# data is loaded in the background so the webhook can answer right after boot
+LOADING_TEXT = "Данные ещё загружаются, попробуйте через минуту."
+
+def load_snapshots():
+    cache = {}
+    for region, raw_url in REES_SHEETS_MAP.items():
+        df = restore_snapshot(region, raw_url)
+        if df is not None:
+            cache[region] = df
+    if cache:
+        install_regions(cache)
+    if VOLS_SHEETS_URL:
+        df = restore_snapshot("VOLS", VOLS_SHEETS_URL)
+        if df is not None:
+            install_vols(df)
+
+def warmup():
+    load_snapshots()
+    for job in (zones_timer, cache_timer, vols_timer, prefetch_help_images):
+        threading.Thread(target=job, daemon=True).start()
 
 # === KEYBOARDS ===
 def main_menu(region: str, region_tp: str):
@@ -146,25 +894,620 @@ VOLS_MENU = ReplyKeyboardMarkup([
 ], resize_keyboard=True)
 
 # === USER STATE ===
-user_states = {}
-known_users = set()
+# approximate deep size of a session state, states only hold str/int/tuple values
+def approx_size(obj) -> int:
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(approx_size(k) + approx_size(v) for k, v in obj.items())
+    elif isinstance(obj, (tuple, list)):
+        size += sum(approx_size(v) for v in obj)
+    return size
+
+# uid -> small state dict (mode, query, row ids), evicted by idle TTL and LRU above a memory cap
+class SessionStore:
+    def __init__(self, ttl: int, max_bytes: int):
+        self.ttl       = ttl
+        self.max_bytes = max_bytes
+        self.items     = OrderedDict()   # uid -> (state, last access, size); oldest access first
+        self.bytes     = 0
+        self.lock      = threading.Lock()
+
+    def _drop(self, uid):
+        _, _, size = self.items.pop(uid)
+        self.bytes -= size
+
+    def get(self, uid, default=None):
+        with self.lock:
+            item = self.items.get(uid)
+            if item is None:
+                return default
+            if time.time() - item[1] > self.ttl:
+                self._drop(uid)
+                return default
+            self.items[uid] = (item[0], time.time(), item[2])
+            self.items.move_to_end(uid)
+            return item[0]
+
+    def __getitem__(self, uid):
+        state = self.get(uid)
+        if state is None:
+            raise KeyError(uid)
+        return state
+
+    def __setitem__(self, uid, state: dict):
+        with self.lock:
+            if uid in self.items:
+                self._drop(uid)
+            if not state:
+                return
+            size = approx_size(state)
+            self.items[uid] = (state, time.time(), size)
+            self.bytes += size
+            now = time.time()
+            while self.items:
+                oldest, (_, touched, _) = next(iter(self.items.items()))
+                if self.bytes <= self.max_bytes and now - touched <= self.ttl:
+                    break
+                self._drop(oldest)
+
+    def __len__(self):
+        return len(self.items)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"count": len(self.items), "bytes": self.bytes, "max_bytes": self.max_bytes}
+
+# === STATE BACKEND ===
+# sessions, known users, dataset version metadata, seen update_ids and short-lived locks;
+# sqlite (default) and redis are shared between gunicorn workers / nodes, memory keeps
+# everything in this process. Locks expire after their ttl so a crashed holder cannot block forever.
+class MemoryState:
+    def __init__(self, ttl: int, max_bytes: int):
+        self.sessions = SessionStore(ttl, max_bytes)
+        self.users_   = set()
+        self.meta     = {}
+        self.updates  = OrderedDict()   # update_id -> first seen, oldest first
+        self.locks    = {}              # name -> (token, expires)
+        self.lock     = threading.Lock()
+
+    def get_session(self, uid):
+        return self.sessions.get(uid)
+
+    def set_session(self, uid, state: dict):
+        self.sessions[uid] = state
+
+    def session_stats(self) -> dict:
+        return self.sessions.stats()
+
+    def add_user(self, uid):
+        self.users_.add(uid)
+
+    def remove_user(self, uid):
+        self.users_.discard(uid)
+
+    def users(self) -> list:
+        return list(self.users_)
+
+    def get_meta(self, key):
+        return self.meta.get(key)
+
+    def set_meta(self, key, value: dict):
+        self.meta[key] = value
+
+    def claim_update(self, update_id: int, ttl: int) -> bool:
+        with self.lock:
+            now = time.time()
+            while self.updates and next(iter(self.updates.values())) < now - ttl:
+                self.updates.popitem(last=False)
+            if update_id in self.updates:
+                return False
+            self.updates[update_id] = now
+            return True
+
+    def release_update(self, update_id: int):
+        with self.lock:
+            self.updates.pop(update_id, None)
+
+    def acquire_lock(self, name: str, ttl: float):
+        with self.lock:
+            held = self.locks.get(name)
+            if held and held[1] > time.time():
+                return None
+            token = uuid.uuid4().hex
+            self.locks[name] = (token, time.time() + ttl)
+            return token
+
+    def release_lock(self, name: str, token: str):
+        with self.lock:
+            if self.locks.get(name, (None,))[0] == token:
+                del self.locks[name]
+
+    def extend_lock(self, name: str, token: str, ttl: float) -> bool:
+        with self.lock:
+            if self.locks.get(name, (None,))[0] != token:
+                return False
+            self.locks[name] = (token, time.time() + ttl)
+            return True
+
+class SqliteState:
+    def __init__(self, path: str, ttl: int):
+        self.path, self.ttl = path, ttl
+        self.local  = threading.local()
+        self.purged = 0.0
+        self.updates_purged = 0.0
+        db = self.db()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("CREATE TABLE IF NOT EXISTS sessions (uid TEXT PRIMARY KEY, state TEXT NOT NULL, touched REAL NOT NULL)")
+        db.execute("CREATE TABLE IF NOT EXISTS users (uid TEXT PRIMARY KEY)")
+        db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        db.execute("CREATE TABLE IF NOT EXISTS updates (update_id INTEGER PRIMARY KEY, seen REAL NOT NULL)")
+        db.execute("CREATE TABLE IF NOT EXISTS locks (name TEXT PRIMARY KEY, token TEXT NOT NULL, expires REAL NOT NULL)")
+
+    # one connection per thread, sqlite connections must not be shared between threads
+    def db(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            # with WAL, NORMAL only syncs at checkpoints; a power loss may drop the last sessions, never corrupt the db
+            conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    # sessions expire after SESSION_TTL idle, so reads count as activity too (written at most once a minute)
+    def get_session(self, uid):
+        db, now = self.db(), time.time()
+        row = db.execute("SELECT state, touched FROM sessions WHERE uid=? AND touched>?", (uid, now - self.ttl)).fetchone()
+        if not row:
+            return None
+        if now - row[1] > 60:
+            db.execute("UPDATE sessions SET touched=? WHERE uid=?", (now, uid))
+        return json.loads(row[0])
+
+    def set_session(self, uid, state: dict):
+        db, now = self.db(), time.time()
+        if state:
+            db.execute("INSERT OR REPLACE INTO sessions (uid, state, touched) VALUES (?, ?, ?)",
+                       (uid, json.dumps(state, ensure_ascii=False), now))
+        else:
+            db.execute("DELETE FROM sessions WHERE uid=?", (uid,))
+        if now - self.purged > 60:
+            self.purged = now
+            db.execute("DELETE FROM sessions WHERE touched<=?", (now - self.ttl,))
+
+    def session_stats(self) -> dict:
+        count, size = self.db().execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(state)), 0) FROM sessions WHERE touched>?",
+                                        (time.time() - self.ttl,)).fetchone()
+        return {"count": count, "bytes": size}
+
+    def add_user(self, uid):
+        self.db().execute("INSERT OR IGNORE INTO users (uid) VALUES (?)", (uid,))
+
+    def remove_user(self, uid):
+        self.db().execute("DELETE FROM users WHERE uid=?", (uid,))
+
+    def users(self) -> list:
+        return [r[0] for r in self.db().execute("SELECT uid FROM users")]
+
+    def get_meta(self, key):
+        row = self.db().execute("SELECT value FROM meta WHERE key=?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_meta(self, key, value: dict):
+        self.db().execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    def claim_update(self, update_id: int, ttl: int) -> bool:
+        db, now = self.db(), time.time()
+        if now - self.updates_purged > 60:
+            self.updates_purged = now
+            db.execute("DELETE FROM updates WHERE seen<?", (now - ttl,))
+        return db.execute("INSERT OR IGNORE INTO updates (update_id, seen) VALUES (?, ?)", (update_id, now)).rowcount == 1
+
+    def release_update(self, update_id: int):
+        self.db().execute("DELETE FROM updates WHERE update_id=?", (update_id,))
+
+    def acquire_lock(self, name: str, ttl: float):
+        db, now, token = self.db(), time.time(), uuid.uuid4().hex
+        db.execute("DELETE FROM locks WHERE name=? AND expires<=?", (name, now))
+        cur = db.execute("INSERT OR IGNORE INTO locks (name, token, expires) VALUES (?, ?, ?)", (name, token, now + ttl))
+        return token if cur.rowcount == 1 else None
+
+    def release_lock(self, name: str, token: str):
+        self.db().execute("DELETE FROM locks WHERE name=? AND token=?", (name, token))
+
+    def extend_lock(self, name: str, token: str, ttl: float) -> bool:
+        cur = self.db().execute("UPDATE locks SET expires=? WHERE name=? AND token=?", (time.time() + ttl, name, token))
+        return cur.rowcount == 1
+
+# speaks the Redis protocol through redis-py, so any compatible server or an in-process
+# stand-in client (e.g. fakeredis) can be used
+class RedisState:
+    def __init__(self, url: str, ttl: int, client=None, prefix: str = "tgbot:"):
+        if client is None:
+            try:
+                import redis
+            except ImportError:
+                raise RuntimeError("STATE_BACKEND=redis needs the redis package (pip install redis)")
+            client = redis.Redis.from_url(url, decode_responses=True)
+        self.r, self.ttl, self.prefix = client, ttl, prefix
+        self.purged = 0.0
+
+    # GETEX restarts the key's TTL, sessions expire after SESSION_TTL idle like in the other backends
+    def get_session(self, uid):
+        with self.r.pipeline(transaction=False) as p:
+            p.getex(f"{self.prefix}session:{uid}", ex=self.ttl)
+            p.zadd(f"{self.prefix}sessions:active", {uid: time.time()}, xx=True)
+            raw, _ = p.execute()
+        return json.loads(raw) if raw else None
+
+    # sessions:active is a sorted set uid -> last write, so counting sessions needs no SCAN
+    def set_session(self, uid, state: dict):
+        key, active, now = f"{self.prefix}session:{uid}", f"{self.prefix}sessions:active", time.time()
+        with self.r.pipeline() as p:
+            if state:
+                p.set(key, json.dumps(state, ensure_ascii=False), ex=self.ttl)
+                p.zadd(active, {uid: now})
+            else:
+                p.delete(key)
+                p.zrem(active, uid)
+            if now - self.purged > 60:
+                self.purged = now
+                p.zremrangebyscore(active, "-inf", now - self.ttl)
+            p.execute()
+
+    # the byte figure would need a STRLEN per session, it is not reported for redis
+    def session_stats(self) -> dict:
+        return {"count": self.r.zcount(f"{self.prefix}sessions:active", time.time() - self.ttl, "+inf"), "bytes": None}
+
+    def add_user(self, uid):
+        self.r.sadd(f"{self.prefix}users", uid)
+
+    def remove_user(self, uid):
+        self.r.srem(f"{self.prefix}users", uid)
+
+    def users(self) -> list:
+        return [u.decode() if isinstance(u, bytes) else u for u in self.r.smembers(f"{self.prefix}users")]
+
+    def get_meta(self, key):
+        raw = self.r.hget(f"{self.prefix}meta", key)
+        return json.loads(raw) if raw else None
+
+    def set_meta(self, key, value: dict):
+        self.r.hset(f"{self.prefix}meta", key, json.dumps(value))
+
+    def claim_update(self, update_id: int, ttl: int) -> bool:
+        return bool(self.r.set(f"{self.prefix}update:{update_id}", 1, nx=True, ex=ttl))
+
+    def release_update(self, update_id: int):
+        self.r.delete(f"{self.prefix}update:{update_id}")
+
+    def acquire_lock(self, name: str, ttl: float):
+        token = uuid.uuid4().hex
+        return token if self.r.set(f"{self.prefix}lock:{name}", token, nx=True, px=int(ttl * 1000)) else None
+
+    # deletes the lock only while it is still ours, it may have expired and been taken by someone else
+    def release_lock(self, name: str, token: str):
+        from redis.exceptions import WatchError
+        key = f"{self.prefix}lock:{name}"
+        with self.r.pipeline() as p:
+            try:
+                p.watch(key)
+                if p.get(key) in (token, token.encode()):
+                    p.multi()
+                    p.delete(key)
+                    p.execute()
+            except WatchError:
+                pass
+
+    def extend_lock(self, name: str, token: str, ttl: float) -> bool:
+        from redis.exceptions import WatchError
+        key = f"{self.prefix}lock:{name}"
+        with self.r.pipeline() as p:
+            try:
+                p.watch(key)
+                if p.get(key) not in (token, token.encode()):
+                    return False
+                p.multi()
+                p.pexpire(key, int(ttl * 1000))
+                return bool(p.execute()[0])
+            except WatchError:
+                return False
+
+def make_state():
+    if STATE_BACKEND == "sqlite":
+        return SqliteState(STATE_DB_PATH, SESSION_TTL)
+    if STATE_BACKEND == "redis":
+        return RedisState(REDIS_URL, SESSION_TTL)
+    if STATE_BACKEND == "memory":
+        return MemoryState(SESSION_TTL, SESSION_MAX_BYTES)
+    raise RuntimeError(f"unknown STATE_BACKEND: {STATE_BACKEND}")
+
+# dict-like view of the backend's sessions, used by the handlers
+class Sessions:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def get(self, uid, default=None):
+        state = self.backend.get_session(uid)
+        return default if state is None else state
+
+    def __getitem__(self, uid):
+        state = self.backend.get_session(uid)
+        if state is None:
+            raise KeyError(uid)
+        return state
+
+    def __setitem__(self, uid, state: dict):
+        self.backend.set_session(uid, state)
+
+    def stats(self) -> dict:
+        return self.backend.session_stats()
+
+# set-like view of broadcast recipients; users already written by this process are not written again
+class KnownUsers:
+    def __init__(self, backend):
+        self.backend = backend
+        self.seen    = set()
+
+    def add(self, uid):
+        if uid not in self.seen:
+            self.backend.add_user(uid)
+            self.seen.add(uid)
+
+    def discard(self, uid):
+        self.backend.remove_user(uid)
+        self.seen.discard(uid)
+
+    def __iter__(self):
+        return iter(self.backend.users())
+
+STATE       = make_state()
+user_states = Sessions(STATE)
+known_users = KnownUsers(STATE)
+
+# row position of the meter picked in search mode; re-resolved through the index after a reload.
+# The cached position is only trusted for the same sheet contents and if it still holds that meter.
+def resolve_row(rees: dict, uid: str, st: dict):
+    part = rees["regions"].get(st["region"])
+    if part is None:
+        return None
+    df, key, pos = rees["data"][st["region"]], normalize_meter(st["number"]), st.get("pos")
+    if (st.get("version") == part["version"] and isinstance(pos, int) and 0 <= pos < len(df)
+            and normalize_meter(df[METER_COL].iat[pos]) == key):
+        return pos
+    hits = part["index"].get(key)
+    if not hits:
+        return None
+    st["pos"], st["version"] = hits[0], part["version"]
+    user_states[uid] = st
+    return hits[0]
+
+# VOLS result rows of a list state; recomputed from the query once the VOLS sheet was reloaded
+def vols_rows(vols: dict, uid: str, st: dict) -> np.ndarray:
+    rows = st.get("rows") or ()
+    if st.get("version") != vols["version"] or (rows and max(rows) >= len(vols["df"])):
+        if st["mode"] == "vols_tp_list":
+            rows = vols["tp_index"].get(st["query"], NO_ROWS)
+        else:
+            rows = search_providers(vols, st["query"])
+        st["rows"], st["version"] = tuple(filter_res(vols, rows, st["region_tp"]).tolist()), vols["version"]
+        user_states[uid] = st
+    return np.asarray(st["rows"], dtype=np.intp)
+
+# button label -> value, "<value> (<count> шт)" ordered by count
+def vols_labels(df: pd.DataFrame, col: str) -> dict:
+    vc = df[col].astype(str).value_counts()
+    return {f"{v} ({cnt} шт)": v for v, cnt in vc.items()}
+
+# === VOLS RESULT PAGES ===
+TG_TEXT_LIMIT = 4096
+
+def vols_selection(vols: dict, uid: str, st: dict) -> pd.DataFrame:
+    df_tp = vols["df"].iloc[vols_rows(vols, uid, st)]
+    return df_tp[df_tp[VOLS_PROV_COL] == st["selected"]]
+
+def render_vols_cards(df: pd.DataFrame) -> list:
+    def col(c):
+        return df[c].astype(str) if c in df.columns else pd.Series("", index=df.index)
+    cards = (
+        "РЭС: " + col("РЭС") +
+        "\nТП:  " + col("Наименование ТП") +
+        "\nФидер: " + col("ФИДЕР") +
+        "\nВУ: " + col("ВУ") +
+        "\nОпоры: " + col("Опоры")
+    )
+    return cards.tolist()
+
+# joins cards into as few messages as fit under Telegram's text limit
+def pack_pages(cards: list, limit: int = TG_TEXT_LIMIT) -> list:
+    pages, cur = [], ""
+    for card in cards:
+        card = card[:limit]
+        if cur and len(cur) + 2 + len(card) > limit:
+            pages.append(cur)
+            cur = card
+        else:
+            cur = f"{cur}\n\n{card}" if cur else card
+    if cur:
+        pages.append(cur)
+    return pages
+
+# identifies the search and contractor a result message shows; its buttons carry it, so pressing
+# them on an older message is not answered from whatever the session holds now
+def vols_token(st: dict) -> str:
+    return hashlib.sha1(f"{st['query']}\n{st['selected']}".encode("utf-8")).hexdigest()[:10]
+
+# callback_data: "vols:page:<token>:<page>" and "vols:csv:<token>"
+def vols_page_markup(token: str, page: int, pages: int, rows: int):
+    buttons = []
+    if pages > 1:
+        nav = []
+        if page > 0:
+            nav.append(InlineKeyboardButton("◀", callback_data=f"vols:page:{token}:{page-1}"))
+        nav.append(InlineKeyboardButton(f"{page+1}/{pages}", callback_data=f"vols:page:{token}:{page}"))
+        if page < pages - 1:
+            nav.append(InlineKeyboardButton("▶", callback_data=f"vols:page:{token}:{page+1}"))
+        buttons.append(nav)
+    if rows > VOLS_DOC_THRESHOLD:
+        buttons.append([InlineKeyboardButton("Скачать CSV", callback_data=f"vols:csv:{token}")])
+    return InlineKeyboardMarkup(buttons) if buttons else None
+
+def handle_vols_callback(update: Update, context: CallbackContext):
+    query = update.callback_query
+    uid   = str(update.effective_user.id)
+    st    = user_states.get(uid, {})
+    parts = query.data.split(":")
+    token = parts[2] if len(parts) > 2 else None
+    if st.get("mode") != "vols_tp_list" or not st.get("selected") or token != vols_token(st):
+        return query.answer("Результаты устарели, выполните поиск заново.")
+    vols = VOLS
+    # sessions outlive restarts, the button may be pressed before VOLS is loaded again
+    if vols["tp_col"] is None:
+        return query.answer(LOADING_TEXT)
+    df_sel = vols_selection(vols, uid, st)
+    if parts[1] == "csv":
+        query.answer()
+        doc = BytesIO(df_sel.to_csv(index=False).encode("utf-8-sig"))
+        return query.message.reply_document(document=doc, filename=f"{st['query']}.csv")
+    pages = pack_pages(render_vols_cards(df_sel))
+    if not pages:
+        return query.answer("Договоров нет.")
+    page = min(int(parts[3]), len(pages) - 1)
+    query.answer()
+    if query.message.text != pages[page]:
+        query.edit_message_text(pages[page], reply_markup=vols_page_markup(token, page, len(pages), len(df_sel)))
+
+# === BROADCAST ===
+# Telegram allows about 30 messages per second overall and one message per second to the same chat
+class RateLimiter:
+    def __init__(self, rate: float, chat_interval: float = 1.0):
+        self.rate          = rate
+        self.tokens        = rate
+        self.updated       = time.monotonic()
+        self.paused_until  = 0.0
+        self.chat_interval = chat_interval
+        self.chat_next     = {}
+        self.lock          = threading.Lock()
+
+    # blocks until both the global bucket and the chat allow one more message
+    def acquire(self, chat_id: int):
+        while True:
+            with self.lock:
+                now  = time.monotonic()
+                self.tokens  = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                wait = max(self.paused_until - now,
+                           self.chat_next.get(chat_id, 0.0) - now,
+                           (1 - self.tokens) / self.rate)
+                if wait <= 0:
+                    self.tokens -= 1
+                    self.chat_next[chat_id] = now + self.chat_interval
+                    if len(self.chat_next) > 10000:
+                        self.chat_next = {c: t for c, t in self.chat_next.items() if t > now}
+                    return
+            time.sleep(wait)
+
+    # a RetryAfter applies to the whole bot, not only to the chat that got it
+    def pause(self, seconds: float):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+RATE_LIMITER = RateLimiter(BROADCAST_RATE)
+
+# Only one broadcast runs at a time over all workers and nodes (a lock in STATE), so the
+# limiter's BROADCAST_RATE is also the bot's overall broadcast rate. The lock lives about
+# twice as long as the broadcast should take, a process dying mid-broadcast does not block the next one for long.
+BROADCAST_LOCK = "broadcast"
+
+def broadcast_lock_ttl(users: int) -> float:
+    return 600 + 2 * users / BROADCAST_RATE
+
+# returns "sent", "blocked" or "failed"
+def send_limited(chat_id: int, text: str, attempts: int = 3) -> str:
+    for attempt in range(attempts):
+        RATE_LIMITER.acquire(chat_id)
+        try:
+            bot.send_message(chat_id=chat_id, text=text)
+            return "sent"
+        except RetryAfter as e:
+            RATE_LIMITER.pause(e.retry_after)
+        except ChatMigrated as e:
+            chat_id = e.new_chat_id
+        except Unauthorized:
+            return "blocked"
+        except BadRequest as e:
+            print(f"[broadcast] {chat_id}: {e}")
+            return "failed"
+        except NetworkError as e:
+            print(f"[broadcast] {chat_id}: {e}")
+            time.sleep(2 ** attempt)
+        except TelegramError as e:
+            print(f"[broadcast] {chat_id}: {e}")
+            return "failed"
+    return "failed"
+
+def run_broadcast(admin_chat_id: int, text: str, users: list, token: str):
+    t0 = time.time()
+    try:
+        with ThreadPoolExecutor(max_workers=BROADCAST_WORKERS) as pool:
+            results = list(pool.map(lambda u: send_limited(int(u), text), users))
+        for u, res in zip(users, results):
+            if res == "blocked":
+                known_users.discard(u)
+        report = (
+            f"Рассылка завершена за {time.time()-t0:.1f} с.\n"
+            f"Доставлено: {results.count('sent')}\n"
+            f"Ошибки: {results.count('failed')}\n"
+            f"Заблокировали бота: {results.count('blocked')}"
+        )
+    except Exception as e:
+        report = f"Рассылка прервана: {e}"
+    finally:
+        try:
+            STATE.release_lock(BROADCAST_LOCK, token)
+        except Exception as e:
+            print(f"[state] Error releasing the broadcast lock: {e}")
+    send_limited(admin_chat_id, report)
+
+def run_reload(admin_chat_id: int, name: str):
+    t0 = time.time()
+    try:
+        # load_sheet publishes the new source meta, other nodes pick it up in sync_versions
+        summary = reload_dataset(name)
+    except Exception as e:
+        summary = f"ошибка: {e}"
+    print(f"[reload] {name}: {summary}")
+    send_limited(admin_chat_id, f"{name}: {summary} ({time.time()-t0:.1f} с)")
 
 # === HANDLERS ===
 def start(update: Update, context: CallbackContext):
-    uid = str(update.effective_user.id)
-    try:
-        info = load_zones_map().get(uid, {})
-    except:
-        info = {}
+    uid   = str(update.effective_user.id)
+    zones = get_zones()
+    if zones is None:
+        return update.message.reply_text(LOADING_TEXT)
+    info = zones.get(uid, {})
     update.message.reply_text("Меню:", reply_markup=main_menu(info.get("region",""), info.get("region_tp","")))
 
+# /reload <РЭС|VOLS> — admin only, refreshes one dataset without waiting for the timer
+def reload_command(update: Update, context: CallbackContext):
+    uid  = str(update.effective_user.id)
+    info = (get_zones() or {}).get(uid, {})
+    if info.get("region", "").lower() != "admin":
+        return update.message.reply_text("У вас нет доступа.")
+    names = list(REES_SHEETS_MAP) + (["VOLS"] if VOLS_SHEETS_URL else [])
+    name  = " ".join(context.args).strip()
+    if not name:
+        return update.message.reply_text("Использование: /reload <набор>\nДоступно: " + ", ".join(names))
+    if name not in names:
+        return update.message.reply_text(f"Неизвестный набор «{name}».\nДоступно: " + ", ".join(names))
+    update.message.reply_text(f"Обновляю {name}...")
+    threading.Thread(target=run_reload, args=(update.effective_chat.id, name), daemon=True).start()
+
+@timed_handler
 def handle_message(update: Update, context: CallbackContext):
     uid  = str(update.effective_user.id)
     txt  = update.message.text.strip()
-    try:
-        zones = load_zones_map()
-    except Exception as e:
-        return update.message.reply_text(f"Ошибка загрузки зон: {e}")
+    zones = get_zones()
+    if zones is None:
+        return update.message.reply_text(LOADING_TEXT)
     info = zones.get(uid)
     if not info:
         return update.message.reply_text("У вас нет доступа.")
@@ -178,14 +1521,19 @@ def handle_message(update: Update, context: CallbackContext):
     is_admin   = region.lower() == "admin"
     is_all     = region.upper() == "ALL"
     search_reg = "ALL" if (is_admin or is_all) else region
+    # one snapshot per update, a reload swapping REES/VOLS meanwhile does not affect this update
+    rees, vols = REES, VOLS
 
     # -- broadcast --
     if state.get("mode") == "broadcast":
-        for u in known_users:
-            try: bot.send_message(chat_id=int(u), text=txt)
-            except: pass
+        set_branch("broadcast")
         user_states[uid] = {}
-        return update.message.reply_text("Рассылка выполнена.", reply_markup=main_menu(region, region_tp))
+        users = list(known_users)
+        token = STATE.acquire_lock(BROADCAST_LOCK, broadcast_lock_ttl(len(users)))
+        if not token:
+            return update.message.reply_text("Предыдущая рассылка ещё выполняется.", reply_markup=main_menu(region, region_tp))
+        threading.Thread(target=run_broadcast, args=(update.effective_chat.id, txt, users, token), daemon=True).start()
+        return update.message.reply_text("Рассылка запущена, отчёт придёт по завершении.", reply_markup=main_menu(region, region_tp))
 
     # -- Поиск по прибору учета --
     if txt == "Поиск по прибору учета":
@@ -219,12 +1567,9 @@ def handle_message(update: Update, context: CallbackContext):
 
     # -- HELP MODE --
     if state.get("mode") == "help":
-        if txt == "Сечение кабеля (ток, мощность)":
-            update.message.reply_photo(photo=IMG_CABLE_URL)
-        elif txt == "Селективность (ток, мощность)":
-            update.message.reply_photo(photo=IMG_SELECTIVITY_URL)
-        elif txt == "Формулы":
-            update.message.reply_photo(photo=IMG_FORMULAS_URL)
+        set_branch("help")
+        if txt in HELP_IMAGES:
+            send_help_image(update.message, txt)
         elif txt == "Назад":
             user_states[uid] = {}
             return update.message.reply_text("Меню:", reply_markup=main_menu(region, region_tp))
@@ -234,64 +1579,55 @@ def handle_message(update: Update, context: CallbackContext):
 
     # -- SEARCH COUNTER --
     if state.get("mode") == "search":
-        norm = txt.strip().lstrip("0") or "0"
-        found = matched = None
+        set_branch("search")
+        hits = meter_hits(rees, txt)
         if search_reg == "ALL":
-            for rgn, df in DATA_CACHE.items():
-                ser      = df["Номер счетчика"].astype(str)
-                norm_ser = ser.str.lstrip("0")
-                if (norm_ser == norm).any():
-                    found, matched = rgn, ser[norm_ser == norm].iloc[0]
-                    break
-            if not found:
+            if not hits:
+                if len(rees["data"]) < len(REES_SHEETS_MAP):
+                    return update.message.reply_text(LOADING_TEXT, reply_markup=main_menu(region, region_tp))
                 return update.message.reply_text("Номер не найден ни в одном регионе.", reply_markup=main_menu(region, region_tp))
         else:
-            df = DATA_CACHE.get(search_reg)
-            if df is None:
+            if search_reg not in rees["data"]:
+                if search_reg in REES_SHEETS_MAP:
+                    return update.message.reply_text(LOADING_TEXT, reply_markup=main_menu(region, region_tp))
                 return update.message.reply_text("У вас нет доступа.")
-            ser      = df["Номер счетчика"].astype(str)
-            norm_ser = ser.str.lstrip("0")
-            if not (norm_ser == norm).any():
+            hits = [h for h in hits if h[0] == search_reg]
+            if not hits:
                 return update.message.reply_text("Номер не найден.", reply_markup=main_menu(region, region_tp))
-            found, matched = search_reg, ser[norm_ser == norm].iloc[0]
+        found, pos = hits[0]
+        matched    = rees["data"][found][METER_COL].iat[pos]
+        version    = rees["regions"][found]["version"]
 
-        user_states[uid] = {"mode":"info","number":matched,"region":found,"region_tp":region_tp}
+        user_states[uid] = {"mode":"info","number":matched,"region":found,"pos":pos,"version":version,"region_tp":region_tp}
         greet = f"Принял в работу, {name}" if name else "Принял в работу"
+        others = sorted({r for r, _ in hits} - {found})
+        if others:
+            greet += f"\nВнимание: номер также найден в регионах: {', '.join(others)}. Показан {found}."
         return update.message.reply_text(greet, reply_markup=INFO_MENU)
 
     # -- INFO COUNTER --
     if state.get("mode") == "info":
+        set_branch("info")
         if txt == "Назад":
             user_states[uid] = {}
             return update.message.reply_text("Меню:", reply_markup=main_menu(region, region_tp))
 
-        st  = user_states[uid]
-        df  = DATA_CACHE.get(st["region"], pd.DataFrame())
-        row = df[df["Номер счетчика"].astype(str) == st["number"]]
-        if row.empty:
+        st  = state
+        # sessions outlive restarts, the region may not be loaded again yet
+        if st["region"] in REES_SHEETS_MAP and st["region"] not in rees["data"]:
+            return update.message.reply_text(LOADING_TEXT, reply_markup=INFO_MENU)
+        pos = resolve_row(rees, uid, st)
+        if pos is None:
             return update.message.reply_text("Данные не найдены.", reply_markup=INFO_MENU)
 
-        if txt == "Информация по договору":
-            cols = ["Номер счетчика","ТУ","Номер ТУСТЕК","Номер ТУ","ЛС / ЛС СТЕК","Наименование договора","Вид потребителя","Субабонент"]
-        elif txt == "Информация по подключению":
-            cols = ["Номер счетчика","Сетевой участок","Населенный пункт","Улица","Дом","Подстанция","Фидер10","ТП"]
-        else:
-            cols = [
-                "Номер счетчика","Максимальная мощность","Вид счетчика","Фазность",
-                "Госповерка счетчика","Межповерочный интервал ПУ","Окончание срок поверки",
-                "Проверка схемы дата","Последнее активное событие дата",
-                "Тип ТТ","Первичный ток ТТ",
-                "Заводской номер ТТ (А)","Заводской номер ТТ (В)","Заводской номер ТТ (С)",
-                "Госповерка ТТ","Межповерочный интервал ТТ","Окончание срок поверки ТТ",
-                "Тип ТН","Заводской номер ТН","Госповерка ТН",
-                "Межповерочный интервал ТН","Окончание срок поверки ТН"
-            ]
-        data = row.iloc[0]
-        lines = [f"{c}: {data[c]}" for c in cols if pd.notna(data.get(c)) and str(data.get(c)).strip()]
+        label = txt if txt in INFO_COLS else "Информация по прибору учета"
+        cols, values = rees["regions"][st["region"]]["views"][label]
+        lines = [f"{c}: {v}" for c, v in zip(cols, values[pos]) if pd.notna(v) and str(v).strip()]
         return update.message.reply_text("\n".join(lines), reply_markup=INFO_MENU)
 
     # -- VOLS MENU --
     if state.get("mode") == "vols_menu":
+        set_branch("vols_menu")
         if txt == "Назад":
             user_states[uid] = {}
             return update.message.reply_text("Меню:", reply_markup=main_menu(region, region_tp))
@@ -304,92 +1640,98 @@ def handle_message(update: Update, context: CallbackContext):
 
     # -- VOLS: SEARCH BY TP --
     if state.get("mode") == "vols_tp_input":
+        set_branch("vols_tp_input")
         if txt == "Назад":
             user_states[uid] = {"mode":"vols_menu","region_tp":region_tp}
             return update.message.reply_text("Меню ВОЛС:", reply_markup=VOLS_MENU)
 
-        tp_raw = txt.strip().upper()
-        tp     = tp_raw if tp_raw.startswith("ТП-") else f"ТП-{tp_raw}"
-        df_tp  = VOLS_DF[VOLS_DF[VOLS_TP_COL].astype(str).str.upper().str.strip() == tp]
-        if df_tp.empty:
+        if vols["tp_col"] is None:
+            return update.message.reply_text(LOADING_TEXT, reply_markup=VOLS_MENU)
+        tp   = normalize_tp(txt)
+        rows = vols["tp_index"].get(tp, NO_ROWS)
+        if not len(rows):
             return update.message.reply_text("Договоров нет.", reply_markup=ReplyKeyboardMarkup([["Новый поиск"],["Назад"]], resize_keyboard=True))
-        if region_tp.upper() != "ALL":
-            df_tp = df_tp[df_tp["РЭС"].astype(str).str.strip() == region_tp]
-            if df_tp.empty:
-                return update.message.reply_text("У вас нет доступа к этой зоне.", reply_markup=ReplyKeyboardMarkup([["Новый поиск"],["Назад"]], resize_keyboard=True))
-        vc = df_tp["Наименование контрагента (собственника ВОЛС)"].astype(str).value_counts()
-        label_map = {f"{n} ({cnt} шт)": n for n,cnt in vc.items()}
+        rows = filter_res(vols, rows, region_tp)
+        if not len(rows):
+            return update.message.reply_text("У вас нет доступа к этой зоне.", reply_markup=ReplyKeyboardMarkup([["Новый поиск"],["Назад"]], resize_keyboard=True))
+        label_map = vols_labels(vols["df"].iloc[rows], VOLS_PROV_COL)
         buttons   = [[lbl] for lbl in label_map] + [["Новый поиск"], ["Назад"]]
-        user_states[uid] = {"mode":"vols_tp_list","df_tp":df_tp,"label_map":label_map,"region_tp":region_tp}
-        return update.message.reply_text(f"На ТП {tp} найдено {len(df_tp)} договор(ов):", reply_markup=ReplyKeyboardMarkup(buttons, resize_keyboard=True))
+        user_states[uid] = {"mode":"vols_tp_list","query":tp,"rows":tuple(rows.tolist()),"version":vols["version"],"region_tp":region_tp}
+        return update.message.reply_text(f"На ТП {tp} найдено {len(rows)} договор(ов):", reply_markup=ReplyKeyboardMarkup(buttons, resize_keyboard=True))
 
     # -- VOLS: LIST TP PROVIDERS --
     if state.get("mode") == "vols_tp_list":
+        set_branch("vols_tp_list")
         if txt == "Новый поиск":
             user_states[uid] = {"mode":"vols_tp_input","region_tp":region_tp}
             return update.message.reply_text("Введите номер ТП:", reply_markup=ReplyKeyboardMarkup([["Назад"]], resize_keyboard=True))
         if txt == "Назад":
             user_states[uid] = {"mode":"vols_menu","region_tp":region_tp}
             return update.message.reply_text("Меню ВОЛС:", reply_markup=VOLS_MENU)
+        if vols["tp_col"] is None:
+            return update.message.reply_text(LOADING_TEXT, reply_markup=ReplyKeyboardMarkup([["Новый поиск"],["Назад"]], resize_keyboard=True))
 
-        name = state["label_map"].get(txt)
+        df_tp     = vols["df"].iloc[vols_rows(vols, uid, state)]
+        label_map = vols_labels(df_tp, VOLS_PROV_COL)
+        name      = label_map.get(txt)
         if not name:
-            kb = [[lbl] for lbl in state["label_map"]] + [["Новый поиск"],["Назад"]]
+            kb = [[lbl] for lbl in label_map] + [["Новый поиск"],["Назад"]]
             return update.message.reply_text(
                 "Выберите из списка:",
                 reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True)
             )
 
-        df_sel = state["df_tp"][state["df_tp"]["Наименование контрагента (собственника ВОЛС)"] == name]
-        for _, row in df_sel.iterrows():
-            update.message.reply_text(
-                f"РЭС: {row.get('РЭС','')}\n"
-                f"ТП:  {row.get('Наименование ТП','')}\n"
-                f"Фидер: {row.get('ФИДЕР','')}\n"
-                f"ВУ: {row.get('ВУ','')}\n"
-                f"Опоры: {row.get('Опоры','')}"
-            )
-        kb = [[lbl] for lbl in state["label_map"]] + [["Новый поиск"],["Назад"]]
+        state["selected"] = name
+        user_states[uid]  = state
+        df_sel = df_tp[df_tp[VOLS_PROV_COL] == name]
+        pages  = pack_pages(render_vols_cards(df_sel))
+        update.message.reply_text(pages[0], reply_markup=vols_page_markup(vols_token(state), 0, len(pages), len(df_sel)))
+        kb = [[lbl] for lbl in label_map] + [["Новый поиск"],["Назад"]]
         return update.message.reply_text("Можно выбрать другого контрагента или Назад.", reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True))
 
     # -- VOLS: SEARCH BY PROVIDER --
     if state.get("mode") == "vols_provider_input":
+        set_branch("vols_provider_input")
         if txt == "Назад":
             user_states[uid] = {"mode":"vols_menu","region_tp":region_tp}
             return update.message.reply_text("Меню ВОЛС:", reply_markup=VOLS_MENU)
+        if vols["tp_col"] is None:
+            return update.message.reply_text(LOADING_TEXT, reply_markup=VOLS_MENU)
         prov = txt.strip().lower()
-        df_p = VOLS_DF[
-            VOLS_DF["Наименование контрагента (собственника ВОЛС)"]
-                .fillna("").str.lower().str.contains(prov)
-        ]
-        if region_tp.upper() != "ALL":
-            df_p = df_p[df_p["РЭС"].astype(str).str.strip() == region_tp]
-        if df_p.empty:
+        if len(prov) > VOLS_QUERY_MAX:
+            return update.message.reply_text(f"Слишком длинный запрос, введите не более {VOLS_QUERY_MAX} символов.",
+                                             reply_markup=ReplyKeyboardMarkup([["Назад"]], resize_keyboard=True))
+        rows = filter_res(vols, search_providers(vols, prov), region_tp)
+        if not len(rows):
             return update.message.reply_text("Контрагент не найден.", reply_markup=ReplyKeyboardMarkup([["Новый поиск"],["Назад"]], resize_keyboard=True))
-        vc = df_p[VOLS_TP_COL].astype(str).value_counts()
-        label_map = {f"{tp} ({cnt} шт)": tp for tp,cnt in vc.items()}
+        label_map = vols_labels(vols["df"].iloc[rows], vols["tp_col"])
         buttons   = [[lbl] for lbl in label_map] + [["Новый поиск"],["Назад"]]
-        user_states[uid] = {"mode":"vols_provider_list","df_p":df_p,"label_map":label_map,"region_tp":region_tp}
-        return update.message.reply_text(f"Найдено договоров: {len(df_p)}", reply_markup=ReplyKeyboardMarkup(buttons, resize_keyboard=True))
+        user_states[uid] = {"mode":"vols_provider_list","query":prov,"rows":tuple(rows.tolist()),"version":vols["version"],"region_tp":region_tp}
+        return update.message.reply_text(f"Найдено договоров: {len(rows)}", reply_markup=ReplyKeyboardMarkup(buttons, resize_keyboard=True))
 
     # -- VOLS: LIST PROVIDER TPs --
     if state.get("mode") == "vols_provider_list":
+        set_branch("vols_provider_list")
         if txt == "Новый поиск":
             user_states[uid] = {"mode":"vols_provider_input","region_tp":region_tp}
             return update.message.reply_text("Введите имя контрагента:", reply_markup=ReplyKeyboardMarkup([["Назад"]], resize_keyboard=True))
         if txt == "Назад":
             user_states[uid] = {"mode":"vols_menu","region_tp":region_tp}
             return update.message.reply_text("Меню ВОЛС:", reply_markup=VOLS_MENU)
+        if vols["tp_col"] is None:
+            return update.message.reply_text(LOADING_TEXT, reply_markup=ReplyKeyboardMarkup([["Новый поиск"],["Назад"]], resize_keyboard=True))
 
-        tp = state["label_map"].get(txt)
+        df_p      = vols["df"].iloc[vols_rows(vols, uid, state)]
+        label_map = vols_labels(df_p, vols["tp_col"])
+        tp        = label_map.get(txt)
         if not tp:
-            kb = [[lbl] for lbl in state["label_map"]] + [["Новый поиск"],["Назад"]]
+            kb = [[lbl] for lbl in label_map] + [["Новый поиск"],["Назад"]]
             return update.message.reply_text(
                 "Выберите из списка:",
                 reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True)
             )
 
-        df_sel = state["df_p"][state["df_p"][VOLS_TP_COL].astype(str) == tp]
+        df_sel = df_p[df_p[vols["tp_col"]].astype(str) == tp]
         update.message.reply_text(f"ТП {tp}: {len(df_sel)} договор(ов)")
         return update.message.reply_text(
             "Новый поиск или Назад?",
@@ -400,18 +1742,207 @@ def handle_message(update: Update, context: CallbackContext):
     user_states[uid] = {}
     return update.message.reply_text("Меню:", reply_markup=main_menu(region, region_tp))
 
+# === UPDATE WORKERS ===
+# updates of one chat always go to the same worker, so they are handled in order
+update_queues = [queue.Queue(maxsize=UPDATE_QUEUE_MAX) for _ in range(UPDATE_WORKERS)]
+UPDATE_STATS  = {"received": 0, "duplicates": 0, "rejected": 0, "processed": 0, "errors": 0,
+                 "latency_sum": 0.0, "latency_max": 0.0}
+_stats_lock   = threading.Lock()
+
+# Telegram redelivers updates it thinks were not acknowledged, possibly to another worker or node,
+# so seen update_ids are kept in STATE. On a STATE error the update is processed rather than dropped.
+DEDUP_TTL = 3600
+
+def mark_seen(update_id: int) -> bool:
+    try:
+        return STATE.claim_update(update_id, DEDUP_TTL)
+    except Exception as e:
+        print(f"[state] Error checking update {update_id}: {e}")
+        return True
+
+def forget_seen(update_id: int):
+    try:
+        STATE.release_update(update_id)
+    except Exception as e:
+        print(f"[state] Error releasing update {update_id}: {e}")
+
+# The per-chat queues only order updates within this process. Updates of one chat that reach
+# different workers are serialized through a lock in STATE, so their session read-modify-write
+# does not interleave. The ttl bounds how long a crashed holder can block the chat; a live holder
+# renews it every ttl/3 while its handler runs. Waiting is capped at CHAT_LOCK_WAIT: past that the
+# update is processed unlocked rather than stalling the worker behind a stuck chat.
+CHAT_LOCK_TTL  = 30
+CHAT_LOCK_WAIT = 10
+
+def renew_chat(name: str, token: str, stop: threading.Event):
+    while not stop.wait(CHAT_LOCK_TTL / 3):
+        try:
+            if not STATE.extend_lock(name, token, CHAT_LOCK_TTL):
+                print(f"[state] Lost {name} while handling it")
+                return
+        except Exception as e:
+            print(f"[state] Error extending {name}: {e}")
+
+def lock_chat(update: Update):
+    chat = update.effective_chat
+    if chat is None:
+        return None
+    name     = f"chat:{chat.id}"
+    deadline = time.time() + CHAT_LOCK_WAIT
+    delay    = 0.02
+    try:
+        while True:
+            token = STATE.acquire_lock(name, CHAT_LOCK_TTL)
+            if token:
+                break
+            if time.time() >= deadline:
+                print(f"[state] {name} still busy after {CHAT_LOCK_WAIT}s, processing unlocked")
+                return None
+            time.sleep(min(delay, max(deadline - time.time(), 0)))
+            delay = min(delay * 2, 0.5)
+    except Exception as e:
+        print(f"[state] Error locking {name}: {e}")
+        return None
+    stop = threading.Event()
+    threading.Thread(target=renew_chat, args=(name, token, stop), daemon=True).start()
+    return name, token, stop
+
+def unlock_chat(held):
+    if held is None:
+        return
+    name, token, stop = held
+    stop.set()
+    try:
+        STATE.release_lock(name, token)
+    except Exception as e:
+        print(f"[state] Error unlocking {name}: {e}")
+
+# Dispatcher.process_update never raises, exceptions of handlers end up here
+def on_error(update, context: CallbackContext):
+    inc("bot_update_errors_total")
+    with _stats_lock:
+        UPDATE_STATS["errors"] += 1
+    update_id = getattr(update, "update_id", None)
+    print(f"[worker] Error processing update {update_id}: {context.error!r}")
+
+def update_worker(q: queue.Queue):
+    while True:
+        update, queued_at = q.get()
+        held = lock_chat(update)
+        try:
+            dispatcher.process_update(update)
+        finally:
+            unlock_chat(held)
+        latency = time.time() - queued_at
+        with _stats_lock:
+            UPDATE_STATS["processed"]   += 1
+            UPDATE_STATS["latency_sum"] += latency
+            UPDATE_STATS["latency_max"]  = max(UPDATE_STATS["latency_max"], latency)
+        q.task_done()
+
+def enqueue_update(update: Update) -> bool:
+    chat = update.effective_chat
+    key  = chat.id if chat else update.update_id
+    try:
+        update_queues[hash(key) % UPDATE_WORKERS].put_nowait((update, time.time()))
+        return True
+    except queue.Full:
+        return False
+
+for q in update_queues:
+    threading.Thread(target=update_worker, args=(q,), daemon=True).start()
+
 # === WEBHOOK & RUN ===
 @app.route("/webhook", methods=["POST"])
 def webhook():
-    dispatcher.process_update(Update.de_json(request.get_json(force=True), bot))
+    try:
+        update = Update.de_json(request.get_json(force=True), bot)
+    except Exception:
+        inc("bot_webhook_requests_total", result="error")
+        raise
+    with _stats_lock:
+        UPDATE_STATS["received"] += 1
+    if not mark_seen(update.update_id):
+        with _stats_lock:
+            UPDATE_STATS["duplicates"] += 1
+        inc("bot_webhook_requests_total", result="duplicate")
+        return "ok"
+    if not enqueue_update(update):
+        # let Telegram redeliver it later instead of dropping it
+        forget_seen(update.update_id)
+        with _stats_lock:
+            UPDATE_STATS["rejected"] += 1
+        inc("bot_webhook_requests_total", result="busy")
+        return "busy", 503
+    inc("bot_webhook_requests_total", result="ok")
     return "ok"
 
 @app.route("/")
 def index():
     return "Бот работает"
 
+@app.route("/ready")
+def ready():
+    now = time.time()
+    def entry(name, data):
+        ts = DATASET_TS.get(name)
+        return {"loaded": data is not None,
+                "rows":   len(data) if data is not None else None,
+                "age":    round(now - ts) if ts else None}
+    datasets = {"ZONES": entry("ZONES", ZONES_MAP)}
+    for region in REES_SHEETS_MAP:
+        datasets[region] = entry(region, REES["data"].get(region))
+    if VOLS_SHEETS_URL:
+        datasets["VOLS"] = entry("VOLS", VOLS["df"] if VOLS["tp_col"] is not None else None)
+    is_ready = all(d["loaded"] for d in datasets.values())
+    return jsonify({"ready": is_ready, "datasets": datasets}), (200 if is_ready else 503)
+
+@app.route("/stats")
+def stats():
+    with _stats_lock:
+        updates = dict(UPDATE_STATS)
+    latency_sum = updates.pop("latency_sum")
+    updates["latency_avg"] = round(latency_sum / updates["processed"], 4) if updates["processed"] else None
+    updates["latency_max"] = round(updates["latency_max"], 4)
+    return jsonify({
+        "queue_depth": [q.qsize() for q in update_queues],
+        "updates":     updates,
+        "sessions":    user_states.stats(),
+    })
+
+@app.route("/metrics")
+def metrics():
+    now      = time.time()
+    datasets = {region: REES["data"].get(region) for region in REES_SHEETS_MAP}
+    if VOLS_SHEETS_URL:
+        datasets["VOLS"] = VOLS["df"] if VOLS["tp_col"] is not None else None
+    sessions = user_states.stats()
+    with _stats_lock:
+        updates = dict(UPDATE_STATS)
+    gauges = [
+        ("bot_cache_rows", "rows in each cached dataset",
+         [((("dataset", n),), len(df)) for n, df in datasets.items() if df is not None]),
+        ("bot_cache_age_seconds", "seconds since each dataset was last confirmed current",
+         [((("dataset", n),), round(now - DATASET_TS[n], 1)) for n in datasets if n in DATASET_TS]),
+        ("bot_cache_load_seconds", "duration of the last download and parse of each dataset",
+         [((("dataset", n),), round(LOAD_SECONDS[n], 3)) for n in datasets if n in LOAD_SECONDS]),
+        ("bot_update_queue_depth", "updates waiting in each worker queue",
+         [((("worker", str(i)),), q.qsize()) for i, q in enumerate(update_queues)]),
+        ("bot_updates_processed", "updates processed since start", [((), updates["processed"])]),
+        ("bot_sessions", "live user sessions", [((), sessions["count"])]),
+        ("bot_sessions_bytes", "approximate memory held by user sessions",
+         [((), sessions["bytes"])] if sessions["bytes"] is not None else []),
+    ]
+    return Response(render_metrics(gauges), mimetype="text/plain; version=0.0.4")
+
 dispatcher.add_handler(CommandHandler("start", start))
+dispatcher.add_handler(CommandHandler("reload", reload_command))
 dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, handle_message))
+dispatcher.add_handler(CallbackQueryHandler(handle_vols_callback, pattern=r"^vols:"))
+dispatcher.add_error_handler(on_error)
+
+if AUTO_WARMUP:
+    warmup()
 
 if __name__ == "__main__":
     def awake():